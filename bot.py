@@ -1,39 +1,116 @@
-import asyncio
+import csv
+import io
+import json
 import logging
+import os
 import re
 import sys
+from datetime import date
+import aiofiles
 from aiogram import Dispatcher, F, filters, types
 from aiogram.enums import ParseMode, ChatAction
 from aiogram.methods.delete_webhook import DeleteWebhook
-from config import URL_PATTERN, ADMIN_USER_IDS
-from spotify import search_spotify, fetch_song_info
-from youtube import download_and_send_audio, download_and_send_audio_direct
-from utils import generate_inline_query_results, create_message_text
-from database import log_action, get_bot_statistics
+from config import URL_PATTERN, ADMIN_USER_IDS, INLINE_CACHE_TIME, CACHE_DIR, INLINE_DEADLINE
+from spotify import search_spotify, fetch_song_info, PartialResults
+from youtube import (
+    download_and_send_audio, download_and_send_audio_direct, download_and_send_album,
+    report_download_failure, report_download_failure_direct
+)
+from utils import generate_inline_query_results_batch, create_message_text
+from database import log_action, get_bot_statistics, iter_statistics, get_file_id
+from debounce import inline_debouncer
+from prefetch import prefetcher
+from sources import download_url
+from deadline import deadline, DeadlineExceeded
+from ytdl_pool import ytdl_pool
+from tasks import task_manager, DOWNLOADS, ALBUMS
+from overload import overload_controller, LEVEL_NAMES
+from models import SongInfo
 from shared import bot
 
 logging.basicConfig(level=logging.INFO, stream=sys.stdout)
 
+# Degraded inline answers shouldn't outlive the overload in Telegram's cache (seconds)
+DEGRADED_INLINE_CACHE_TIME = 10
+
+def schedule_prefetch(song_info: SongInfo, user_id: int):
+    """Start downloading a track the user is likely to pick from inline results"""
+    yt_url = song_info.youtube_music_url
+    if yt_url and not song_info.is_album and not overload_controller.links_only:
+        prefetcher.schedule(yt_url, song_info, user_id)
+
+def inline_cache_time(links_only: bool) -> int:
+    return DEGRADED_INLINE_CACHE_TIME if links_only else INLINE_CACHE_TIME
+
+async def admit_download(info_msg: types.Message, url: str = None) -> bool:
+    """Whether to start a download now; while overloaded only already uploaded tracks are sent"""
+    if not overload_controller.refusing_downloads or (url and await get_file_id(url)):
+        return True
+    minutes = overload_controller.retry_after_minutes()
+    await info_msg.edit_reply_markup(
+        reply_markup=types.InlineKeyboardMarkup(inline_keyboard=[
+            [types.InlineKeyboardButton(text=f"⏳ Busy, try again in {minutes} min", callback_data="busy")]
+        ])
+    )
+    await info_msg.answer(f"😓 I'm overloaded right now and can't start new downloads. Please try again in {minutes} min.")
+    return False
+
+def submit_download(coro, name: str, user_id: int, info_msg: types.Message, category: str = DOWNLOADS):
+    """Run a download in the background, reporting unexpected failures on its info message"""
+    task_manager.submit(
+        coro,
+        name,
+        owner=user_id,
+        category=category,
+        on_error=lambda e: report_download_failure_direct(info_msg.chat.id, info_msg.message_id, str(e))
+    )
+
+async def answer_timed_out(inline_query: types.InlineQuery):
+    """Answer before Telegram gives up on the query, so the user isn't left with a spinner"""
+    await inline_query.answer([
+        types.InlineQueryResultArticle(
+            id="timeout",
+            title="This is taking too long, please try again...",
+            input_message_content=types.InputTextMessageContent(
+                message_text=f"Tried to share music: {inline_query.query}",
+                disable_web_page_preview=True
+            )
+        )
+    ], cache_time=1)
+
 def init_bot():
     dp = Dispatcher()
 
     @dp.inline_query(F.query.regexp(URL_PATTERN))
     async def search_song(inline_query: types.InlineQuery):
         query = inline_query.query
-        
-        # Log the inline query action
-        await log_action(
-            user_id=inline_query.from_user.id,
-            username=inline_query.from_user.username,
-            action_type="inline_query",
-            url=query
-        )
-        
-        song_info = await fetch_song_info(query)
+        links_only = overload_controller.links_only
 
-        if song_info:
-            result = await generate_inline_query_results(song_info)
-            await inline_query.answer(result)
+        async def resolve():
+            # Log the inline query action
+            await log_action(
+                user_id=inline_query.from_user.id,
+                username=inline_query.from_user.username,
+                action_type="inline_query",
+                url=query
+            )
+
+            song_info = await fetch_song_info(query)
+            if song_info:
+                schedule_prefetch(song_info, inline_query.from_user.id)
+                return await generate_inline_query_results_batch([song_info], preview=links_only)
+
+        try:
+            async with deadline(INLINE_DEADLINE):
+                completed, result = await inline_debouncer.run(inline_query.from_user.id, resolve)
+        except DeadlineExceeded:
+            await answer_timed_out(inline_query)
+            return
+        if not completed:
+            return
+
+        if result:
+            await inline_query.answer(result, cache_time=inline_cache_time(links_only), is_personal=False)
         else:
             await inline_query.answer([
                 types.InlineQueryResultArticle(
@@ -44,7 +121,7 @@ def init_bot():
                         disable_web_page_preview=True
                     )
                 )
-            ])
+            ], cache_time=1)
 
     @dp.inline_query()
     async def default_handler(inline_query: types.InlineQuery):
@@ -56,25 +133,45 @@ def init_bot():
                 title='Paste song url or search query in the message field...',
                 input_message_content=types.InputTextMessageContent(message_text=f'@{bot_info.username} - share music via any links')
             )
-            await inline_query.answer([result])
+            await inline_query.answer([result], cache_time=INLINE_CACHE_TIME, is_personal=False)
             return
-        
-        # Log the inline search query action
-        await log_action(
-            user_id=inline_query.from_user.id,
-            username=inline_query.from_user.username,
-            action_type="inline_query",
-            query=query_text
-        )
-        
-        search_results = await search_spotify(query_text)
-        results = []
-        for song in search_results:
-            song_info = await fetch_song_info(song['url'])
-            result = await generate_inline_query_results(song_info, preview=False)
-            results.extend(result)
 
-        await inline_query.answer(results, cache_time=1)
+        links_only = overload_controller.links_only
+
+        async def resolve():
+            # Log the inline search query action
+            await log_action(
+                user_id=inline_query.from_user.id,
+                username=inline_query.from_user.username,
+                action_type="inline_query",
+                query=query_text
+            )
+
+            search_results = await search_spotify(query_text, allow_prefix=True)
+            song_infos = []
+            for song in search_results:
+                song_info = await fetch_song_info(song['url'])
+                if song_info:
+                    song_infos.append(song_info)
+            if song_infos:
+                schedule_prefetch(song_infos[0], inline_query.from_user.id)
+            partial = isinstance(search_results, PartialResults)
+            return await generate_inline_query_results_batch(song_infos, preview=links_only), partial
+
+        try:
+            async with deadline(INLINE_DEADLINE):
+                completed, answer = await inline_debouncer.run(inline_query.from_user.id, resolve)
+        except DeadlineExceeded:
+            await answer_timed_out(inline_query)
+            return
+        if not completed:
+            return
+        results, partial = answer
+
+        # Search results don't depend on who asked, so let Telegram share them between users,
+        # but not for long when they were only filtered from a shorter query's results
+        cache_time = inline_cache_time(links_only) if results and not partial else 1
+        await inline_query.answer(results, cache_time=cache_time, is_personal=False)
 
     @dp.message(filters.CommandStart())
     async def start(msg: types.Message):
@@ -129,7 +226,9 @@ def init_bot():
                         'start_command': '🚀',
                         'url_download': '🔗',
                         'search_query': '🔍',
-                        'inline_query': '⚡'
+                        'inline_query': '⚡',
+                        'inline_download': '📥',
+                        'export_command': '📤'
                     }.get(action_type, '📝')
                     stats_text += f"{action_emoji} {action_type.replace('_', ' ').title()}: {count}\n"
                 stats_text += "\n"
@@ -145,8 +244,19 @@ def init_bot():
             # Daily stats
             if stats['daily_stats']:
                 stats_text += "📅 **Daily Activity (Last 7 Days):**\n"
-                for date, count in stats['daily_stats']:
-                    stats_text += f"📊 {date}: {count} actions\n"
+                for day, count in stats['daily_stats']:
+                    stats_text += f"📊 {day}: {count} actions\n"
+
+            stats_text += f"\n🚦 **Load:** {LEVEL_NAMES[overload_controller.level]}\n"
+
+            # Download worker setup cost, to compare YTDL_POOL_ENABLED on and off
+            ytdl_stats = ytdl_pool.stats()
+            stats_text += (
+                f"\n⚙️ **YoutubeDL {'pool' if ytdl_stats['enabled'] else 'per download'}:** "
+                f"{ytdl_stats['created']} created, {ytdl_stats['reused']} reused, "
+                f"{ytdl_stats['setup_ms_per_download']:.0f} ms setup and "
+                f"{ytdl_stats['extract_seconds_per_download']:.1f} s extraction per download\n"
+            )
             
             await msg.answer(stats_text, parse_mode=ParseMode.MARKDOWN)
             
@@ -161,6 +271,56 @@ def init_bot():
             logging.error(f"Error generating statistics: {e}")
             await msg.answer("❌ Error generating statistics. Please try again later.")
 
+    @dp.message(filters.Command("export"))
+    async def export_stats(msg: types.Message, command: filters.CommandObject):
+        """Export raw statistics for a date range as CSV or JSONL"""
+        if not ADMIN_USER_IDS or msg.from_user.id not in ADMIN_USER_IDS:
+            await msg.answer("🚫 This command is only available for bot administrators.")
+            return
+
+        args = (command.args or "").split()
+        try:
+            start, end = (date.fromisoformat(arg).isoformat() for arg in args[:2])
+        except ValueError:
+            args = []
+        export_format = args[2].lower() if len(args) > 2 else "csv"
+        if len(args) < 2 or export_format not in ("csv", "jsonl"):
+            await msg.answer("Usage: <code>/export YYYY-MM-DD YYYY-MM-DD [csv|jsonl]</code>")
+            return
+
+        await bot.send_chat_action(msg.chat.id, ChatAction.UPLOAD_DOCUMENT)
+
+        filename = CACHE_DIR / f"statistics_{start}_{end}_{msg.message_id}.{export_format}"
+        columns = ("timestamp", "user_id", "username", "action_type", "url", "query", "count")
+        try:
+            # Written chunk by chunk, so the export never has to fit in memory
+            async with aiofiles.open(filename, "w", newline="") as f:
+                if export_format == "csv":
+                    await f.write(",".join(columns) + "\r\n")
+                async for rows in iter_statistics(start, end):
+                    chunk = io.StringIO()
+                    if export_format == "csv":
+                        csv.writer(chunk).writerows(rows)
+                    else:
+                        for row in rows:
+                            chunk.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n")
+                    await f.write(chunk.getvalue())
+
+            await msg.answer_document(types.FSInputFile(filename), caption=f"📊 Statistics {start} — {end}")
+
+            # Log the export command usage
+            await log_action(
+                user_id=msg.from_user.id,
+                username=msg.from_user.username,
+                action_type="export_command"
+            )
+        except Exception as e:
+            logging.error(f"Error exporting statistics: {e}")
+            await msg.answer("❌ Error exporting statistics. Please try again later.")
+        finally:
+            if os.path.exists(filename):
+                os.remove(filename)
+
     @dp.message(filters.Command("help"))
     async def show_help(msg: types.Message):
         """Show available commands"""
@@ -173,6 +333,7 @@ def init_bot():
         # Add stats command for admins
         if ADMIN_USER_IDS and msg.from_user.id in ADMIN_USER_IDS:
             help_text += "📊 `/stats` - View bot usage statistics (Admin only)\n"
+            help_text += "📤 `/export` - Export statistics for a date range (Admin only)\n"
         
         help_text += (
             "\n🎵 **How to use:**\n"
@@ -216,24 +377,33 @@ def init_bot():
         if song_info:
             # Create a message with song info
             message_text = await create_message_text(song_info)
-            is_album = song_info.get('type') == 'album'
+            is_album = song_info.is_album
             
             if is_album:
-                # For albums, just send the info without download functionality
-                await msg.answer(
+                # For albums, send the info and download all tracks as media groups
+                info_msg = await msg.answer(
                     message_text,
                     link_preview_options=types.LinkPreviewOptions(
-                        url=song_info['thumbnailUrl'], 
+                        url=song_info.thumbnail_url, 
                         prefer_large_media=True, 
                         show_above_text=True
-                    )
+                    ),
+                    reply_markup=types.InlineKeyboardMarkup(inline_keyboard=[
+                        [types.InlineKeyboardButton(text="⏳ Downloading...", callback_data="downloading")]
+                    ])
                 )
+                await bot.send_chat_action(msg.chat.id, ChatAction.UPLOAD_VOICE)
+                if await admit_download(info_msg):
+                    submit_download(
+                        download_and_send_album(msg.chat.id, info_msg.message_id, song_info),
+                        f"album {song_info.spotify_url}", msg.from_user.id, info_msg, ALBUMS
+                    )
             else:
                 # For songs, send info and start downloading
                 info_msg = await msg.answer(
                     message_text,
                     link_preview_options=types.LinkPreviewOptions(
-                        url=song_info['thumbnailUrl'], 
+                        url=song_info.thumbnail_url, 
                         prefer_large_media=True, 
                         show_above_text=True
                     ),
@@ -246,14 +416,13 @@ def init_bot():
                 await bot.send_chat_action(msg.chat.id, ChatAction.UPLOAD_VOICE)
                 
                 # Start downloading in background
-                yt_url = song_info['platform_urls'].get('YTMusic')
-                if yt_url:
-                    await asyncio.create_task(download_and_send_audio_direct(
-                        msg.chat.id, 
-                        info_msg.message_id, 
-                        yt_url, 
-                        msg.from_user.id
-                    ))
+                source_url = download_url(song_info)
+                if source_url:
+                    if await admit_download(info_msg, source_url):
+                        submit_download(
+                            download_and_send_audio_direct(msg.chat.id, info_msg.message_id, source_url, msg.from_user.id),
+                            f"download {source_url}", msg.from_user.id, info_msg
+                        )
                 else:
                     # Update button if no downloadable URL found
                     await info_msg.edit_reply_markup(
@@ -285,34 +454,45 @@ def init_bot():
         await bot.send_chat_action(msg.chat.id, ChatAction.TYPING)
         
         # Search on Spotify
-        search_results = await search_spotify(query)
+        try:
+            search_results = await search_spotify(query)
+            # Take the first result (most relevant)
+            song_info = search_results and await fetch_song_info(search_results[0]['url'])
+        except Exception as e:
+            await msg.answer(f"❌ Search failed, please try again later.\n\n<code>{e}</code>")
+            return
         
         if search_results:
-            # Take the first result (most relevant)
-            first_result = search_results[0]
-            song_info = await fetch_song_info(first_result['url'])
-            
             if song_info:
                 # Create a message with song info
                 message_text = await create_message_text(song_info)
-                is_album = song_info.get('type') == 'album'
+                is_album = song_info.is_album
                 
                 if is_album:
-                    # For albums, just send the info without download functionality
-                    await msg.answer(
+                    # For albums, send the info and download all tracks as media groups
+                    info_msg = await msg.answer(
                         message_text,
                         link_preview_options=types.LinkPreviewOptions(
-                            url=song_info['thumbnailUrl'], 
+                            url=song_info.thumbnail_url, 
                             prefer_large_media=True, 
                             show_above_text=True
-                        )
+                        ),
+                        reply_markup=types.InlineKeyboardMarkup(inline_keyboard=[
+                            [types.InlineKeyboardButton(text="⏳ Downloading...", callback_data="downloading")]
+                        ])
                     )
+                    await bot.send_chat_action(msg.chat.id, ChatAction.UPLOAD_VOICE)
+                    if await admit_download(info_msg):
+                        submit_download(
+                            download_and_send_album(msg.chat.id, info_msg.message_id, song_info),
+                            f"album {song_info.spotify_url}", msg.from_user.id, info_msg, ALBUMS
+                        )
                 else:
                     # For songs, send info and start downloading
                     info_msg = await msg.answer(
                         message_text,
                         link_preview_options=types.LinkPreviewOptions(
-                            url=song_info['thumbnailUrl'], 
+                            url=song_info.thumbnail_url, 
                             prefer_large_media=True, 
                             show_above_text=True
                         ),
@@ -325,14 +505,13 @@ def init_bot():
                     await bot.send_chat_action(msg.chat.id, ChatAction.UPLOAD_VOICE)
                     
                     # Start downloading in background
-                    yt_url = song_info['platform_urls'].get('YTMusic')
-                    if yt_url:
-                        await asyncio.create_task(download_and_send_audio_direct(
-                            msg.chat.id, 
-                            info_msg.message_id, 
-                            yt_url, 
-                            msg.from_user.id
-                        ))
+                    source_url = download_url(song_info)
+                    if source_url:
+                        if await admit_download(info_msg, source_url):
+                            submit_download(
+                                download_and_send_audio_direct(msg.chat.id, info_msg.message_id, source_url, msg.from_user.id),
+                                f"download {source_url}", msg.from_user.id, info_msg
+                            )
                     else:
                         # Update button if no downloadable URL found
                         await info_msg.edit_reply_markup(
@@ -353,6 +532,10 @@ def init_bot():
     async def handle_download_success(call: types.CallbackQuery):
         await call.answer("Track downloaded successfully! 🎵", show_alert=False)
 
+    @dp.callback_query(F.data == "busy")
+    async def handle_busy(call: types.CallbackQuery):
+        await call.answer("The bot is overloaded right now, please try again later.", show_alert=True)
+
     @dp.callback_query(F.data == "downloading")
     async def handle_downloading(call: types.CallbackQuery):
         await call.answer("Downloading in progress, please wait... ⏳", show_alert=False)
@@ -364,7 +547,24 @@ def init_bot():
     @dp.chosen_inline_result()
     async def load_song(res: types.ChosenInlineResult):
         if re.match(URL_PATTERN, res.result_id) and '.link/' not in res.result_id:
-            await asyncio.create_task(download_and_send_audio(res))
+            # Log the inline download action
+            await log_action(
+                user_id=res.from_user.id,
+                username=res.from_user.username,
+                action_type="inline_download",
+                url=res.result_id
+            )
+            if overload_controller.refusing_downloads and not await get_file_id(res.result_id):
+                minutes = overload_controller.retry_after_minutes()
+                await report_download_failure(res, f"The bot is overloaded, please try again in {minutes} min")
+                return
+            task_manager.submit(
+                download_and_send_audio(res),
+                f"inline download {res.result_id}",
+                owner=res.from_user.id,
+                category=DOWNLOADS,
+                on_error=lambda e: report_download_failure(res, str(e))
+            )
 
     return bot, dp
 
@@ -18,3 +18,125 @@ COOKIE_FILE = BASE_DIR / 'downloads' / 'youtube_cookies.txt'
 CACHE_DIR = BASE_DIR / 'downloads' / 'cache'
 
 CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+# Inline query debounce window (seconds), adapted to each user's typing speed
+INLINE_DEBOUNCE_MIN = float(os.environ.get("INLINE_DEBOUNCE_MIN", "0.3"))
+INLINE_DEBOUNCE_MAX = float(os.environ.get("INLINE_DEBOUNCE_MAX", "1.2"))
+# How long Telegram may cache inline answers on its side (seconds)
+INLINE_CACHE_TIME = int(os.environ.get("INLINE_CACHE_TIME", "300"))
+
+# Spotify search result cache
+SEARCH_CACHE_SIZE = int(os.environ.get("SEARCH_CACHE_SIZE", "5000"))
+SEARCH_CACHE_TTL = int(os.environ.get("SEARCH_CACHE_TTL", "3600"))
+
+# Speculative download of the top inline result before the user picks it (opt-in)
+PREFETCH_ENABLED = os.environ.get("PREFETCH_ENABLED", "false").lower() in ("1", "true", "yes")
+PREFETCH_MAX_CONCURRENT = int(os.environ.get("PREFETCH_MAX_CONCURRENT", "2"))
+# Bandwidth budget per prefetch in bytes per second (0 = unlimited)
+PREFETCH_RATE_LIMIT = int(os.environ.get("PREFETCH_RATE_LIMIT", str(512 * 1024)))
+# How long an unclaimed prefetch is kept, and how often a track must have been requested to keep it longer
+PREFETCH_KEEP_SECONDS = int(os.environ.get("PREFETCH_KEEP_SECONDS", "600"))
+PREFETCH_POPULAR_REQUESTS = int(os.environ.get("PREFETCH_POPULAR_REQUESTS", "3"))
+
+# song.link metadata cache
+SONG_INFO_CACHE_SIZE = int(os.environ.get("SONG_INFO_CACHE_SIZE", "20000"))
+SONG_INFO_CACHE_TTL = int(os.environ.get("SONG_INFO_CACHE_TTL", str(24 * 3600)))
+# song.link results are also kept in the database, for this many days
+SONG_INFO_DB_TTL = int(os.environ.get("SONG_INFO_DB_TTL", "30"))
+
+# Background cache warm-up from request statistics
+WARMUP_ENABLED = os.environ.get("WARMUP_ENABLED", "true").lower() in ("1", "true", "yes")
+# Chat (e.g. a private channel) that warmed-up audio is uploaded to; audio is not warmed without it
+WARMUP_CHAT_ID = int(os.environ.get("WARMUP_CHAT_ID")) if os.environ.get("WARMUP_CHAT_ID") else None
+WARMUP_STARTUP_DELAY = int(os.environ.get("WARMUP_STARTUP_DELAY", "60"))
+WARMUP_INTERVAL = int(os.environ.get("WARMUP_INTERVAL", "3600"))
+# Off-peak hours (UTC, start-end) during which warm-up repeats every WARMUP_INTERVAL
+WARMUP_HOURS = os.environ.get("WARMUP_HOURS", "2-6")
+WARMUP_DAYS = int(os.environ.get("WARMUP_DAYS", "30"))
+WARMUP_MAX_METADATA = int(os.environ.get("WARMUP_MAX_METADATA", "100"))
+WARMUP_MAX_DOWNLOADS = int(os.environ.get("WARMUP_MAX_DOWNLOADS", "10"))
+
+# Album downloads
+ALBUM_DOWNLOAD_CONCURRENCY = int(os.environ.get("ALBUM_DOWNLOAD_CONCURRENCY", "3"))
+ALBUM_MAX_TRACKS = int(os.environ.get("ALBUM_MAX_TRACKS", "50"))
+
+# Local cache of resized audio thumbnails
+THUMBNAIL_DIR = CACHE_DIR / 'thumbnails'
+THUMBNAIL_CACHE_BYTES = int(os.environ.get("THUMBNAIL_CACHE_BYTES", str(200 * 1024 * 1024)))
+
+THUMBNAIL_DIR.mkdir(parents=True, exist_ok=True)
+
+# Outbound routes: upstream proxies (comma-separated) and optionally a direct connection
+PROXY_URLS = [url.strip() for url in os.environ.get("PROXY_URLS", os.environ.get("PROXY_URL", "socks5://shadowsocks:1080")).split(",") if url.strip()]
+PROXY_ALLOW_DIRECT = os.environ.get("PROXY_ALLOW_DIRECT", "false").lower() in ("1", "true", "yes")
+# Per-destination routing, e.g. "api.telegram.org=direct,youtube.com=proxy,googlevideo.com=proxy"
+PROXY_ROUTES = os.environ.get("PROXY_ROUTES", "")
+PROXY_PROBE_URL = os.environ.get("PROXY_PROBE_URL", "https://www.gstatic.com/generate_204")
+PROXY_PROBE_INTERVAL = int(os.environ.get("PROXY_PROBE_INTERVAL", "60"))
+# Consecutive failures after which a route is skipped for PROXY_COOLDOWN seconds
+PROXY_FAILURE_THRESHOLD = int(os.environ.get("PROXY_FAILURE_THRESHOLD", "3"))
+PROXY_COOLDOWN = int(os.environ.get("PROXY_COOLDOWN", "60"))
+
+# Statistics retention: raw events are kept this long, then compacted into daily aggregates
+STATS_RETENTION_DAYS = int(os.environ.get("STATS_RETENTION_DAYS", "30"))
+STATS_RETENTION_INTERVAL = int(os.environ.get("STATS_RETENTION_INTERVAL", "3600"))
+# Free pages returned to the filesystem per compacted day
+STATS_VACUUM_PAGES = int(os.environ.get("STATS_VACUUM_PAGES", "1000"))
+
+# Longest track that is downloaded at all (seconds); the size planner keeps long ones under the upload limit
+MAX_TRACK_DURATION = int(os.environ.get("MAX_TRACK_DURATION", str(60 * 60)))
+# Self-hosted telegram-bot-api server (e.g. http://telegram-bot-api:8081); the public API is used when unset or unreachable
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL") or None
+# Whether that server runs with --local and shares the downloads volume, so uploads can pass file paths
+TELEGRAM_API_LOCAL = os.environ.get("TELEGRAM_API_LOCAL", "true").lower() in ("1", "true", "yes")
+# Bot API upload limit in bytes: 50 MB on the public API, 2000 MB on a local server
+TELEGRAM_UPLOAD_LIMIT = int(os.environ.get(
+    "TELEGRAM_UPLOAD_LIMIT",
+    str((2000 if TELEGRAM_API_URL and TELEGRAM_API_LOCAL else 50) * 1024 * 1024)
+))
+# The local server answers an upload only once it has passed the file on to Telegram (seconds)
+TELEGRAM_API_UPLOAD_TIMEOUT = float(os.environ.get("TELEGRAM_API_UPLOAD_TIMEOUT", "600"))
+
+# Outgoing Telegram rate limits (messages per second)
+TELEGRAM_GLOBAL_RATE = float(os.environ.get("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_PRIVATE_CHAT_RATE = float(os.environ.get("TELEGRAM_PRIVATE_CHAT_RATE", "1"))
+TELEGRAM_GROUP_CHAT_RATE = float(os.environ.get("TELEGRAM_GROUP_CHAT_RATE", str(20 / 60)))
+TELEGRAM_MAX_RETRIES = int(os.environ.get("TELEGRAM_MAX_RETRIES", "3"))
+
+# Hedged downloads: a second source is tried when the first is slower than its usual latency allows
+HEDGE_MIN_DELAY = float(os.environ.get("HEDGE_MIN_DELAY", "10"))
+HEDGE_MAX_DELAY = float(os.environ.get("HEDGE_MAX_DELAY", "60"))
+
+# Time budgets (seconds): Telegram drops inline answers after about 10 seconds
+INLINE_DEADLINE = float(os.environ.get("INLINE_DEADLINE", "8"))
+DOWNLOAD_DEADLINE = float(os.environ.get("DOWNLOAD_DEADLINE", "300"))
+# Upper bound for any single outbound HTTP request or stalled download connection
+HTTP_TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", "15"))
+
+# Reused YoutubeDL instances, one per download thread and proxy
+YTDL_POOL_ENABLED = os.environ.get("YTDL_POOL_ENABLED", "true").lower() in ("1", "true", "yes")
+YTDL_MAX_USES = int(os.environ.get("YTDL_MAX_USES", "100"))
+YTDL_MAX_AGE = int(os.environ.get("YTDL_MAX_AGE", "3600"))
+YTDL_COOKIE_SAVE_INTERVAL = int(os.environ.get("YTDL_COOKIE_SAVE_INTERVAL", "600"))
+
+# Threads running yt-dlp; every download, hedge and album track competes for them
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", "4"))
+# Downloads handled at once per kind; more wait their turn without holding up other updates
+DOWNLOAD_TASK_LIMIT = int(os.environ.get("DOWNLOAD_TASK_LIMIT", "8"))
+ALBUM_TASK_LIMIT = int(os.environ.get("ALBUM_TASK_LIMIT", "2"))
+# How long running downloads may finish after the bot is asked to stop (seconds)
+SHUTDOWN_GRACE = float(os.environ.get("SHUTDOWN_GRACE", "30"))
+
+# Overload protection: soft limits switch inline results to link cards only,
+# hard limits also refuse new downloads. Queue depth counts downloads waiting for a slot
+# or a download thread.
+OVERLOAD_QUEUE_SOFT = int(os.environ.get("OVERLOAD_QUEUE_SOFT", "4"))
+OVERLOAD_QUEUE_HARD = int(os.environ.get("OVERLOAD_QUEUE_HARD", "16"))
+# Event loop lag (seconds)
+OVERLOAD_LAG_SOFT = float(os.environ.get("OVERLOAD_LAG_SOFT", "0.5"))
+OVERLOAD_LAG_HARD = float(os.environ.get("OVERLOAD_LAG_HARD", "2"))
+# Share of failed upstream requests and downloads over the last minute
+OVERLOAD_ERROR_RATE_SOFT = float(os.environ.get("OVERLOAD_ERROR_RATE_SOFT", "0.5"))
+OVERLOAD_ERROR_RATE_HARD = float(os.environ.get("OVERLOAD_ERROR_RATE_HARD", "0.8"))
+# How long load must stay low before stepping back up (seconds)
+OVERLOAD_RECOVERY = float(os.environ.get("OVERLOAD_RECOVERY", "60"))
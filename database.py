@@ -1,10 +1,14 @@
+import asyncio
 import logging
 import aiosqlite
-from config import DB_PATH
+from config import DB_PATH, STATS_RETENTION_DAYS, STATS_RETENTION_INTERVAL, STATS_VACUUM_PAGES, SONG_INFO_DB_TTL
 
 async def init_db():
     try:
         async with aiosqlite.connect(DB_PATH) as db:
+            # Only takes effect on a new database; lets retention give space back without a full VACUUM
+            await db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+
             await db.execute('''
                 CREATE TABLE IF NOT EXISTS downloads
                 (url TEXT PRIMARY KEY, file_id TEXT)
@@ -23,8 +27,61 @@ async def init_db():
                     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
                 )
             ''')
+            await db.execute("CREATE INDEX IF NOT EXISTS statistics_timestamp ON statistics (timestamp)")
+            await db.execute("CREATE INDEX IF NOT EXISTS statistics_url ON statistics (url)")
+
+            # Raw events older than the retention window, compacted per day
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS statistics_daily
+                (
+                    date TEXT,
+                    user_id INTEGER,
+                    username TEXT,
+                    action_type TEXT,
+                    url TEXT,
+                    count INTEGER
+                )
+            ''')
+            await db.execute("CREATE INDEX IF NOT EXISTS statistics_daily_date ON statistics_daily (date)")
+
+            # Download size planner decisions, to compare estimates with real sizes
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS download_plans
+                (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    url TEXT,
+                    duration INTEGER,
+                    decision TEXT,
+                    format_id TEXT,
+                    source_codec TEXT,
+                    bitrate INTEGER,
+                    estimated_size INTEGER,
+                    actual_size INTEGER,
+                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # song.link lookups, SongInfo.to_bytes() encoded
+            await db.execute('''
+                CREATE TABLE IF NOT EXISTS song_info
+                (url TEXT PRIMARY KEY, data BLOB, updated_at DATETIME DEFAULT CURRENT_TIMESTAMP)
+            ''')
+            await db.execute("CREATE INDEX IF NOT EXISTS song_info_updated_at ON song_info (updated_at)")
+
+            # Raw and compacted statistics in one shape; every raw event counts once
+            await db.execute('''
+                CREATE VIEW IF NOT EXISTS statistics_all AS
+                SELECT user_id, username, action_type, url, query, timestamp, 1 AS count FROM statistics
+                UNION ALL
+                SELECT user_id, username, action_type, url, NULL AS query, date AS timestamp, count FROM statistics_daily
+            ''')
             
             await db.commit()
+
+            async with db.execute("PRAGMA auto_vacuum") as cursor:
+                auto_vacuum = (await cursor.fetchone())[0]
+            if auto_vacuum != 2:
+                logging.info('Database predates incremental vacuum; space freed by retention will be reused, not returned')
     except aiosqlite.OperationalError as e:
         logging.error(f'Failed to create table (check if db file exists): {e}')
         if not DB_PATH.exists():
@@ -42,9 +99,47 @@ async def get_file_id(url: str):
             result = await cursor.fetchone()
             return result[0] if result else None
 
+async def get_file_ids(urls: list) -> dict:
+    """Look up file IDs for several URLs in a single query"""
+    urls = [url for url in urls if url]
+    if not urls:
+        return {}
+    placeholders = ", ".join("?" for _ in urls)
+    async with aiosqlite.connect(DB_PATH) as db:
+        async with db.execute(f"SELECT url, file_id FROM downloads WHERE url IN ({placeholders})", urls) as cursor:
+            return dict(await cursor.fetchall())
+
 async def save_file_id(url: str, file_id: str):
     async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("INSERT INTO downloads (url, file_id) VALUES (?, ?)", (url, file_id))
+        await db.execute("INSERT OR REPLACE INTO downloads (url, file_id) VALUES (?, ?)", (url, file_id))
+        await db.commit()
+
+async def get_song_info(url: str, max_age_days: int):
+    async with aiosqlite.connect(DB_PATH) as db:
+        async with db.execute(
+            "SELECT data FROM song_info WHERE url = ? AND updated_at >= datetime('now', ?)",
+            (url, f'-{max_age_days} days')
+        ) as cursor:
+            result = await cursor.fetchone()
+            return result[0] if result else None
+
+async def save_song_info(url: str, data: bytes):
+    async with aiosqlite.connect(DB_PATH) as db:
+        await db.execute(
+            "INSERT OR REPLACE INTO song_info (url, data, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)",
+            (url, data)
+        )
+        await db.commit()
+
+async def save_download_plan(url: str, plan, actual_size: int = None):
+    """Record a download planner decision"""
+    async with aiosqlite.connect(DB_PATH) as db:
+        await db.execute(
+            """INSERT INTO download_plans
+               (url, duration, decision, format_id, source_codec, bitrate, estimated_size, actual_size)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+            (url, plan.duration, plan.decision, plan.format_id, plan.source_codec, plan.bitrate, plan.estimated_size, actual_size)
+        )
         await db.commit()
 
 async def log_action(user_id: int, username: str, action_type: str, url: str = None, query: str = None):
@@ -62,19 +157,19 @@ async def get_bot_statistics():
         stats = {}
         
         # Total users
-        async with db.execute("SELECT COUNT(DISTINCT user_id) FROM statistics") as cursor:
+        async with db.execute("SELECT COUNT(DISTINCT user_id) FROM statistics_all") as cursor:
             result = await cursor.fetchone()
             stats['total_users'] = result[0] if result else 0
         
         # Total actions
-        async with db.execute("SELECT COUNT(*) FROM statistics") as cursor:
+        async with db.execute("SELECT SUM(count) FROM statistics_all") as cursor:
             result = await cursor.fetchone()
-            stats['total_actions'] = result[0] if result else 0
+            stats['total_actions'] = result[0] or 0 if result else 0
         
         # Actions by type
         async with db.execute("""
-            SELECT action_type, COUNT(*) as count 
-            FROM statistics 
+            SELECT action_type, SUM(count) as count 
+            FROM statistics_all 
             GROUP BY action_type 
             ORDER BY count DESC
         """) as cursor:
@@ -82,8 +177,8 @@ async def get_bot_statistics():
         
         # Top users by activity
         async with db.execute("""
-            SELECT username, user_id, COUNT(*) as action_count 
-            FROM statistics 
+            SELECT username, user_id, SUM(count) as action_count 
+            FROM statistics_all 
             WHERE username IS NOT NULL
             GROUP BY user_id 
             ORDER BY action_count DESC 
@@ -93,8 +188,8 @@ async def get_bot_statistics():
         
         # Daily statistics for last 7 days
         async with db.execute("""
-            SELECT DATE(timestamp) as date, COUNT(*) as count 
-            FROM statistics 
+            SELECT DATE(timestamp) as date, SUM(count) as count 
+            FROM statistics_all 
             WHERE timestamp >= datetime('now', '-7 days')
             GROUP BY DATE(timestamp) 
             ORDER BY date DESC
@@ -107,3 +202,129 @@ async def get_bot_statistics():
             stats['total_downloads'] = result[0] if result else 0
         
         return stats
+
+async def count_requests(urls: list, days: int = 7) -> int:
+    """Count how often any of the given URLs was requested recently"""
+    if not urls:
+        return 0
+    placeholders = ", ".join("?" for _ in urls)
+    async with aiosqlite.connect(DB_PATH) as db:
+        async with db.execute(
+            f"SELECT SUM(count) FROM statistics_all WHERE url IN ({placeholders}) AND timestamp >= datetime('now', ?)",
+            (*urls, f'-{days} days')
+        ) as cursor:
+            result = await cursor.fetchone()
+            return result[0] or 0 if result else 0
+
+async def get_popular_urls(days: int, limit: int) -> list:
+    """Most requested URLs over the last `days` days"""
+    async with aiosqlite.connect(DB_PATH) as db:
+        async with db.execute("""
+            SELECT url, SUM(count) as count
+            FROM statistics_all
+            WHERE url IS NOT NULL AND timestamp >= datetime('now', ?)
+            GROUP BY url
+            ORDER BY count DESC
+            LIMIT ?
+        """, (f'-{days} days', limit)) as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+
+async def get_trending_urls(limit: int) -> list:
+    """URLs requested much more in the last day than in the week before"""
+    async with aiosqlite.connect(DB_PATH) as db:
+        async with db.execute("""
+            SELECT url,
+                   SUM(count * (timestamp >= datetime('now', '-1 day'))) as recent,
+                   SUM(count * (timestamp < datetime('now', '-1 day'))) as prior
+            FROM statistics_all
+            WHERE url IS NOT NULL AND timestamp >= datetime('now', '-8 days')
+            GROUP BY url
+            HAVING recent > 0
+            ORDER BY recent * 7.0 / (prior + 7) DESC
+            LIMIT ?
+        """, (limit,)) as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+
+async def get_popular_queries(days: int, limit: int) -> list:
+    """Most repeated search queries over the last `days` days"""
+    async with aiosqlite.connect(DB_PATH) as db:
+        async with db.execute("""
+            SELECT LOWER(TRIM(query)) as normalized, COUNT(*) as count
+            FROM statistics
+            WHERE query IS NOT NULL AND action_type = 'search_query' AND timestamp >= datetime('now', ?)
+            GROUP BY normalized
+            ORDER BY count DESC
+            LIMIT ?
+        """, (f'-{days} days', limit)) as cursor:
+            return [row[0] for row in await cursor.fetchall()]
+
+async def compact_statistics(retention_days: int, vacuum_pages: int):
+    """Fold raw statistics older than the retention window into daily aggregates, one day at a time"""
+    compacted_days = 0
+    async with aiosqlite.connect(DB_PATH) as db:
+        while True:
+            async with db.execute(
+                "SELECT DATE(MIN(timestamp)) FROM statistics WHERE timestamp < date('now', ?)",
+                (f'-{retention_days} days',)
+            ) as cursor:
+                day = (await cursor.fetchone())[0]
+            if not day:
+                break
+
+            await db.execute("""
+                INSERT INTO statistics_daily (date, user_id, username, action_type, url, count)
+                SELECT DATE(timestamp), user_id, MAX(username), action_type, url, COUNT(*)
+                FROM statistics
+                WHERE timestamp >= ? AND timestamp < date(?, '+1 day')
+                GROUP BY DATE(timestamp), user_id, action_type, url
+            """, (day, day))
+            await db.execute("DELETE FROM statistics WHERE timestamp >= ? AND timestamp < date(?, '+1 day')", (day, day))
+            await db.commit()
+
+            # Give a bounded number of free pages back per day, instead of one long VACUUM
+            async with db.execute(f"PRAGMA incremental_vacuum({int(vacuum_pages)})") as cursor:
+                await cursor.fetchall()
+            compacted_days += 1
+    return compacted_days
+
+async def expire_song_info(max_age_days: int, vacuum_pages: int):
+    """Delete song.link lookups too old for get_song_info to return"""
+    async with aiosqlite.connect(DB_PATH) as db:
+        cursor = await db.execute("DELETE FROM song_info WHERE updated_at < datetime('now', ?)", (f'-{max_age_days} days',))
+        await db.commit()
+        if cursor.rowcount:
+            async with db.execute(f"PRAGMA incremental_vacuum({int(vacuum_pages)})") as vacuum:
+                await vacuum.fetchall()
+        return cursor.rowcount
+
+async def run_statistics_retention():
+    """Periodically compact statistics older than STATS_RETENTION_DAYS and expire old song.link lookups"""
+    while True:
+        try:
+            compacted_days = await compact_statistics(STATS_RETENTION_DAYS, STATS_VACUUM_PAGES)
+            if compacted_days:
+                logging.info(f"Compacted {compacted_days} days of statistics")
+        except Exception as e:
+            logging.error(f"Statistics compaction failed: {e}")
+        try:
+            expired = await expire_song_info(SONG_INFO_DB_TTL, STATS_VACUUM_PAGES)
+            if expired:
+                logging.info(f"Expired {expired} stored song.link lookups")
+        except Exception as e:
+            logging.error(f"Song info expiry failed: {e}")
+        await asyncio.sleep(STATS_RETENTION_INTERVAL)
+
+async def iter_statistics(start: str, end: str, chunk_size: int = 1000):
+    """Yield statistics between two dates (inclusive) in chunks, without loading them all"""
+    async with aiosqlite.connect(DB_PATH) as db:
+        async with db.execute("""
+            SELECT timestamp, user_id, username, action_type, url, query, count
+            FROM statistics_all
+            WHERE timestamp >= ? AND timestamp < date(?, '+1 day')
+            ORDER BY timestamp
+        """, (start, end)) as cursor:
+            while True:
+                rows = await cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield rows
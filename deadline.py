@@ -0,0 +1,48 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+
+# Absolute time.monotonic() by which the current update must be handled, None when unbounded
+_expires_at = ContextVar('expires_at', default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+def expires_at():
+    return _expires_at.get()
+
+def remaining(default: float = None):
+    """Seconds left in the current budget, or `default` when there is none"""
+    expiry = _expires_at.get()
+    if expiry is None:
+        return default
+    return max(0.0, expiry - time.monotonic())
+
+@asynccontextmanager
+async def deadline(seconds: float):
+    """Give the block a time budget, cancelling it when the budget runs out.
+
+    The budget is visible to everything the block awaits, including tasks it
+    creates. A nested budget can shorten an outer one but never extend it.
+    """
+    expiry = time.monotonic() + seconds
+    outer = _expires_at.get()
+    if outer is not None:
+        expiry = min(expiry, outer)
+    budget = expiry - time.monotonic()
+    token = _expires_at.set(expiry)
+    timeout = asyncio.timeout(budget)
+    try:
+        async with timeout:
+            yield
+    except DeadlineExceeded:
+        raise
+    except TimeoutError as e:
+        if timeout.expired():
+            raise DeadlineExceeded(f"Timed out after {budget:.3g} seconds") from e
+        raise
+    finally:
+        _expires_at.reset(token)
@@ -0,0 +1,82 @@
+import asyncio
+import time
+from config import INLINE_DEBOUNCE_MIN, INLINE_DEBOUNCE_MAX
+
+# A pause longer than this means the user started a new query, not kept typing
+IDLE_RESET_SECONDS = 5.0
+
+
+class InlineQueryDebouncer:
+    """Keeps at most one in-flight inline query per user.
+
+    Every new query from a user cancels the previous one before it reaches
+    Spotify or song.link, and waits a short window (adapted to how fast the
+    user types) to see whether yet another keystroke is coming.
+    """
+
+    def __init__(self, min_delay: float = INLINE_DEBOUNCE_MIN, max_delay: float = INLINE_DEBOUNCE_MAX):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self._tasks = {}
+        self._last_seen = {}
+        self._typing_gap = {}
+
+    def _next_delay(self, user_id: int) -> float:
+        now = time.monotonic()
+        last_seen = self._last_seen.get(user_id)
+        self._last_seen[user_id] = now
+
+        if last_seen is None or now - last_seen > IDLE_RESET_SECONDS:
+            self._typing_gap.pop(user_id, None)
+            return self.min_delay
+
+        # Exponentially weighted average of the gap between keystrokes
+        gap = now - last_seen
+        average = self._typing_gap.get(user_id, gap)
+        average = 0.7 * average + 0.3 * gap
+        self._typing_gap[user_id] = average
+
+        if average >= self.max_delay:
+            return self.min_delay
+        return min(self.max_delay, max(self.min_delay, average * 1.2))
+
+    async def _delayed(self, delay: float, work):
+        await asyncio.sleep(delay)
+        return await work()
+
+    async def run(self, user_id: int, work):
+        """Run `work()` unless a newer query from the same user supersedes it.
+
+        Returns `(True, result)` when the work completed and `(False, None)`
+        when it was superseded.
+        """
+        if len(self._last_seen) > 1000:
+            self._forget_idle()
+
+        previous = self._tasks.get(user_id)
+        if previous and not previous.done():
+            previous.cancel()
+
+        task = asyncio.create_task(self._delayed(self._next_delay(user_id), work))
+        self._tasks[user_id] = task
+        try:
+            return True, await task
+        except asyncio.CancelledError:
+            if task.cancelled() and self._tasks.get(user_id) is not task:
+                return False, None
+            task.cancel()
+            raise
+        finally:
+            if self._tasks.get(user_id) is task:
+                del self._tasks[user_id]
+
+    def _forget_idle(self):
+        """Drop typing statistics of users who have gone quiet."""
+        now = time.monotonic()
+        for user_id, last_seen in list(self._last_seen.items()):
+            if now - last_seen > IDLE_RESET_SECONDS and user_id not in self._tasks:
+                del self._last_seen[user_id]
+                self._typing_gap.pop(user_id, None)
+
+
+inline_debouncer = InlineQueryDebouncer()
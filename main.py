@@ -1,11 +1,25 @@
 import asyncio
 from bot import init_bot, start_polling
-from database import init_db
+from config import SHUTDOWN_GRACE
+from database import init_db, run_statistics_retention
+from proxy import proxy_pool
+from warmup import cache_warmer
+from ytdl_pool import ytdl_pool
+from tasks import task_manager, BACKGROUND
+from overload import overload_controller
 
 async def main():
     await init_db()
     bot, dp = init_bot()
-    await start_polling(bot, dp)
+    task_manager.submit(proxy_pool.run_health_checks(), "proxy health checks", category=BACKGROUND)
+    task_manager.submit(cache_warmer.run(), "cache warm-up", category=BACKGROUND)
+    task_manager.submit(run_statistics_retention(), "statistics retention", category=BACKGROUND)
+    task_manager.submit(overload_controller.run(), "overload monitor", category=BACKGROUND)
+    try:
+        await start_polling(bot, dp)
+    finally:
+        await task_manager.shutdown(SHUTDOWN_GRACE)
+        ytdl_pool.close_all()
 
 if __name__ == '__main__':
     asyncio.run(main())
@@ -0,0 +1,103 @@
+from dataclasses import dataclass, fields
+
+# Entities song.link returns that make poor track info (odd titles, no artwork)
+SKIPPED_ENTITIES = frozenset(('ANGHAMI_SONG', 'BOOMPLAY_SONG'))
+# Link labels shown on the card, in card order
+PLATFORMS = (
+    ('Spotify', 'spotify_url'),
+    ('Yandex', 'yandex_url'),
+    ('SoundCloud', 'soundcloud_url'),
+    ('YTMusic', 'youtube_music_url'),
+)
+# Bumped whenever the encoded field list changes, so stale cache entries are ignored
+ENCODING_VERSION = b'\x01'
+SEPARATOR = '\x00'
+
+
+@dataclass(frozen=True, slots=True)
+class SongInfo:
+    title: str
+    artist_name: str
+    thumbnail_url: str
+    type: str = 'song'
+    page_url: str = None
+    spotify_url: str = None
+    yandex_url: str = None
+    soundcloud_url: str = None
+    youtube_music_url: str = None
+    youtube_url: str = None
+
+    @classmethod
+    def from_songlink(cls, data: dict):
+        """Build from a song.link response, or return None when it names no usable track"""
+        entity = None
+        for key, value in data.get('entitiesByUniqueId', {}).items():
+            kind = key.partition('::')[0]
+            if 'thumbnailUrl' not in value or kind in SKIPPED_ENTITIES or kind.startswith('SOUNDCLOUD'):
+                continue
+            entity = value
+            # YouTube titles are often "Artist - Title (Official Video)"; keep looking for a better one
+            if not kind.startswith('YOUTUBE'):
+                break
+        if entity is None:
+            return None
+
+        links = data.get('linksByPlatform', {})
+
+        def link(platform):
+            return links[platform]['url'] if platform in links else None
+
+        # The separator can't appear in encoded fields; URLs never contain it
+        return cls(
+            (entity.get('title') or '').replace(SEPARATOR, ''),
+            (entity.get('artistName') or '').replace(SEPARATOR, ''),
+            entity['thumbnailUrl'],
+            entity.get('type', 'song'),
+            data.get('pageUrl'),
+            link('spotify'),
+            link('yandex'),
+            link('soundcloud'),
+            link('youtubeMusic'),
+            link('youtube'),
+        )
+
+    @property
+    def is_album(self) -> bool:
+        return self.type == 'album'
+
+    @property
+    def platform_urls(self) -> dict:
+        """Links for the card, by label, starting with the song.link page"""
+        urls = {'All': self.page_url} if self.page_url else {}
+        for label, attribute in PLATFORMS:
+            url = getattr(self, attribute)
+            if url:
+                urls[label] = url
+        return urls
+
+    @property
+    def source_urls(self) -> dict:
+        """Links yt-dlp can download from, in order of preference"""
+        sources = {'YTMusic': self.youtube_music_url, 'YouTube': self.youtube_url, 'SoundCloud': self.soundcloud_url}
+        return {source: url for source, url in sources.items() if url}
+
+    @property
+    def urls(self) -> list:
+        """Every link to this track, e.g. for matching statistics"""
+        return [url for url in (self.page_url, self.spotify_url, self.yandex_url, self.soundcloud_url,
+                                self.youtube_music_url, self.youtube_url) if url]
+
+    def to_bytes(self) -> bytes:
+        values = (getattr(self, f.name) for f in ENCODED_FIELDS)
+        return ENCODING_VERSION + SEPARATOR.join(value or '' for value in values).encode()
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        """Decode `to_bytes` output; None for entries written by another encoding version"""
+        if data[:1] != ENCODING_VERSION:
+            return None
+        title, artist_name, thumbnail_url, type, *urls = data[1:].decode().split(SEPARATOR)
+        return cls(title, artist_name, thumbnail_url, type, *(url or None for url in urls))
+
+
+ENCODED_FIELDS = fields(SongInfo)
@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from config import (
+    DOWNLOAD_WORKERS, OVERLOAD_QUEUE_SOFT, OVERLOAD_QUEUE_HARD, OVERLOAD_LAG_SOFT, OVERLOAD_LAG_HARD,
+    OVERLOAD_ERROR_RATE_SOFT, OVERLOAD_ERROR_RATE_HARD, OVERLOAD_RECOVERY
+)
+from tasks import task_manager, download_executor, DOWNLOADS
+
+NORMAL = 0
+# Inline answers are link cards (and already uploaded audio) only
+LINKS_ONLY = 1
+# New downloads are refused as well; already uploaded tracks are still sent
+REFUSING = 2
+LEVEL_NAMES = ('normal', 'links only', 'refusing downloads')
+
+CHECK_INTERVAL = 1.0
+# Upstream results older than this don't count towards the error rate (seconds)
+ERROR_WINDOW = 60
+# Fewer results than this in the window say nothing about the error rate
+MIN_ERROR_SAMPLES = 10
+
+
+class OverloadController:
+    """Steps the bot down into degraded modes when it can't keep up, and back up when it can.
+
+    Load is judged by the number of downloads waiting for a slot or a download
+    thread (the threads are the real bottleneck: hedges and album tracks use them
+    too), event loop
+    lag and the recent failure rate of upstream requests. Degrading happens one
+    level per check; recovering one level only after load has stayed below that
+    level for OVERLOAD_RECOVERY seconds, so the bot doesn't flap.
+    """
+
+    def __init__(self):
+        self.level = NORMAL
+        self.loop_lag = 0.0
+        self._upstream = deque()
+        self._calm_since = None
+
+    @property
+    def links_only(self) -> bool:
+        return self.level >= LINKS_ONLY
+
+    @property
+    def refusing_downloads(self) -> bool:
+        return self.level >= REFUSING
+
+    def record_upstream(self, success: bool):
+        self._upstream.append((time.monotonic(), success))
+
+    def error_rate(self) -> float:
+        cutoff = time.monotonic() - ERROR_WINDOW
+        while self._upstream and self._upstream[0][0] < cutoff:
+            self._upstream.popleft()
+        if len(self._upstream) < MIN_ERROR_SAMPLES:
+            return 0.0
+        return sum(1 for _, success in self._upstream if not success) / len(self._upstream)
+
+    @staticmethod
+    def queued_downloads() -> int:
+        return task_manager.queued(DOWNLOADS) + download_executor.queued()
+
+    def target_level(self) -> int:
+        queued = self.queued_downloads()
+        error_rate = self.error_rate()
+        if queued >= OVERLOAD_QUEUE_HARD or self.loop_lag >= OVERLOAD_LAG_HARD or error_rate >= OVERLOAD_ERROR_RATE_HARD:
+            return REFUSING
+        if queued >= OVERLOAD_QUEUE_SOFT or self.loop_lag >= OVERLOAD_LAG_SOFT or error_rate >= OVERLOAD_ERROR_RATE_SOFT:
+            return LINKS_ONLY
+        return NORMAL
+
+    def retry_after_minutes(self) -> int:
+        """Rough time until the current download backlog is worked off"""
+        backlog = self.queued_downloads() + download_executor.running()
+        average = task_manager.durations.get(DOWNLOADS, 60)
+        return max(1, math.ceil(backlog * average / DOWNLOAD_WORKERS / 60))
+
+    def update(self):
+        target = self.target_level()
+        now = time.monotonic()
+        if target > self.level:
+            self._set_level(self.level + 1)
+            self._calm_since = None
+        elif target < self.level:
+            if self._calm_since is None:
+                self._calm_since = now
+            elif now - self._calm_since >= OVERLOAD_RECOVERY:
+                self._set_level(self.level - 1)
+                self._calm_since = now
+        else:
+            self._calm_since = None
+
+    def _set_level(self, level: int):
+        logging.warning(
+            f"Overload level {LEVEL_NAMES[self.level]} -> {LEVEL_NAMES[level]} "
+            f"(queued downloads {self.queued_downloads()}, loop lag {self.loop_lag:.2f}s, "
+            f"upstream errors {self.error_rate():.0%})"
+        )
+        self.level = level
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(CHECK_INTERVAL)
+            # How late the loop got around to waking us up
+            lag = max(0.0, loop.time() - started - CHECK_INTERVAL)
+            self.loop_lag = 0.7 * self.loop_lag + 0.3 * lag
+            self.update()
+
+
+overload_controller = OverloadController()
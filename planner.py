@@ -0,0 +1,102 @@
+from typing import NamedTuple
+
+# Bitrate ffmpeg's AAC encoder uses when converting without an explicit quality (kbit/s)
+DEFAULT_ENCODE_BITRATE = 128
+# Below this the result is not worth sending (kbit/s)
+MIN_ENCODE_BITRATE = 48
+# Headroom for container overhead and estimation error
+SIZE_SAFETY = 0.95
+
+COPY = 'copy'
+REENCODE = 'reencode'
+REDUCED = 'reduced'
+REFUSED = 'refused'
+
+
+class DownloadPlan(NamedTuple):
+    decision: str
+    format_id: str = None
+    source_codec: str = None
+    # Target bitrate for re-encoding, None to keep the encoder default
+    bitrate: int = None
+    estimated_size: int = None
+    duration: int = 0
+    reason: str = None
+
+
+class DownloadRefusal(str):
+    """Reason a track is not downloaded; reads like the plain message, carries the plan"""
+    plan: DownloadPlan = None
+
+    @classmethod
+    def from_plan(cls, plan: DownloadPlan) -> 'DownloadRefusal':
+        refusal = cls(plan.reason)
+        refusal.plan = plan
+        return refusal
+
+
+def _is_aac(audio_format: dict) -> bool:
+    return (audio_format.get('acodec') or '').startswith('mp4a')
+
+def _source_size(audio_format: dict, duration: float):
+    size = audio_format.get('filesize') or audio_format.get('filesize_approx')
+    if size:
+        return size
+    bitrate = audio_format.get('abr') or audio_format.get('tbr')
+    if bitrate and duration:
+        return int(bitrate * 1000 / 8 * duration)
+    return None
+
+def _final_size(audio_format: dict, duration: float, bitrate: int = None):
+    # AAC sources are copied into the m4a container as is, anything else is converted to AAC
+    if _is_aac(audio_format) and bitrate is None:
+        return _source_size(audio_format, duration)
+    return int((bitrate or DEFAULT_ENCODE_BITRATE) * 1000 / 8 * duration)
+
+def plan_download(info_dict: dict, size_limit: int) -> DownloadPlan:
+    """Pick the best audio format whose converted file fits under `size_limit` bytes"""
+    duration = info_dict.get('duration') or 0
+    limit = size_limit * SIZE_SAFETY
+
+    audio_formats = [
+        f for f in info_dict.get('formats') or []
+        if f.get('vcodec') == 'none' and f.get('acodec') not in (None, 'none')
+    ]
+    if not audio_formats:
+        # Nothing to plan with; let yt-dlp pick as before
+        return DownloadPlan(REENCODE, 'bestaudio', duration=duration)
+
+    audio_formats.sort(key=lambda f: f.get('abr') or f.get('tbr') or 0, reverse=True)
+
+    for audio_format in audio_formats:
+        size = _final_size(audio_format, duration)
+        if size is not None and size <= limit:
+            return DownloadPlan(
+                COPY if _is_aac(audio_format) else REENCODE,
+                audio_format['format_id'],
+                audio_format.get('acodec'),
+                estimated_size=size,
+                duration=duration
+            )
+
+    # Nothing fits at its natural bitrate: convert at the highest bitrate that does
+    if duration:
+        bitrate = int(limit * 8 / duration / 1000)
+        convertible = [f for f in audio_formats if not _is_aac(f)]
+        if bitrate >= MIN_ENCODE_BITRATE and convertible:
+            # Only non-AAC sources are guaranteed to be re-encoded rather than copied
+            audio_format = convertible[0]
+            return DownloadPlan(
+                REDUCED,
+                audio_format['format_id'],
+                audio_format.get('acodec'),
+                bitrate,
+                _final_size(audio_format, duration, bitrate),
+                duration
+            )
+
+    return DownloadPlan(
+        REFUSED,
+        duration=duration,
+        reason=f"Track is too long to fit Telegram's {size_limit // (1024 * 1024)} MB upload limit"
+    )
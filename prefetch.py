@@ -0,0 +1,106 @@
+import asyncio
+import logging
+import time
+from config import (
+    PREFETCH_ENABLED, PREFETCH_MAX_CONCURRENT, PREFETCH_RATE_LIMIT,
+    PREFETCH_KEEP_SECONDS, PREFETCH_POPULAR_REQUESTS, DOWNLOAD_DEADLINE
+)
+from database import get_file_id, count_requests
+from models import SongInfo
+from tasks import task_manager, PREFETCH
+from youtube import DownloadControl, pending_downloads, remove_downloaded_file, start_download
+
+# Popular prefetches are kept for at most this many extra PREFETCH_KEEP_SECONDS periods
+MAX_KEEP_ROUNDS = 6
+
+
+class Prefetcher:
+    """Starts downloading likely inline picks before the user chooses them.
+
+    Prefetched downloads are registered in `pending_downloads`, where
+    `fetch_audio` takes them over once the result is actually chosen.
+    Unclaimed ones are cancelled when their owner moves on, or deleted after
+    PREFETCH_KEEP_SECONDS, unless the track is popular.
+    """
+
+    def __init__(self):
+        self._jobs = {}
+        self._owners = {}
+        self._kept = {}
+
+    def schedule(self, url: str, song_info: SongInfo, owner: int):
+        if not PREFETCH_ENABLED or url in self._jobs or url in pending_downloads:
+            return
+        task_manager.submit(self._start(url, song_info, owner), f"prefetch {url}", owner, PREFETCH)
+
+    def _is_unclaimed(self, url: str) -> bool:
+        job = self._jobs.get(url)
+        return job is not None and pending_downloads.get(url) is job
+
+    async def _is_popular(self, url: str) -> bool:
+        song_info = self._jobs[url].song_info
+        urls = song_info.urls if song_info else [url]
+        return await count_requests(urls) >= PREFETCH_POPULAR_REQUESTS
+
+    async def _start(self, url: str, song_info: SongInfo, owner: int):
+        if url in self._jobs or await get_file_id(url):
+            return
+
+        # The owner's previous pick is now unlikely to be chosen
+        previous = self._owners.get(owner)
+        if previous and previous != url and self._is_unclaimed(previous) and not self._jobs[previous].task.done():
+            if not await self._is_popular(previous):
+                self._discard(previous)
+
+        running = sum(1 for job in self._jobs.values() if not job.task.done())
+        if running >= PREFETCH_MAX_CONCURRENT or url in self._jobs or url in pending_downloads:
+            return
+
+        control = DownloadControl(ratelimit=PREFETCH_RATE_LIMIT or None, deadline=time.monotonic() + DOWNLOAD_DEADLINE)
+        job = start_download(url, song_info, control)
+        self._jobs[url] = job
+        self._kept[url] = 0
+        self._owners[owner] = url
+        job.task.add_done_callback(lambda _: self._expire_later(url, job))
+
+    def _expire_later(self, url: str, job):
+        loop = asyncio.get_event_loop()
+        loop.call_later(PREFETCH_KEEP_SECONDS, lambda: self._schedule_expiry(url, job))
+
+    def _schedule_expiry(self, url: str, job):
+        task_manager.submit(self._expire(url, job), f"prefetch expiry {url}", category=PREFETCH)
+
+    async def _expire(self, url: str, job):
+        if self._jobs.get(url) is not job:
+            return
+        if not self._is_unclaimed(url):
+            # Claimed by fetch_audio, which now owns the file
+            self._forget(url)
+            return
+        if self._kept[url] < MAX_KEEP_ROUNDS and await self._is_popular(url):
+            self._kept[url] += 1
+            logging.info(f"Keeping popular prefetched track {url}")
+            self._expire_later(url, job)
+            return
+        self._discard(url)
+
+    def _forget(self, url: str):
+        del self._jobs[url]
+        del self._kept[url]
+        for owner, owned_url in list(self._owners.items()):
+            if owned_url == url:
+                del self._owners[owner]
+
+    def _discard(self, url: str):
+        job = self._jobs[url]
+        self._forget(url)
+        pending_downloads.pop(url, None)
+        if job.task.done():
+            remove_downloaded_file(job.task)
+        else:
+            job.control.cancel()
+            # The download may still finish before it notices the cancellation
+            job.task.add_done_callback(remove_downloaded_file)
+
+
+prefetcher = Prefetcher()
@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import threading
+import time
+from contextlib import asynccontextmanager
+from urllib.parse import urlparse
+import aiohttp
+from aiohttp_socks import ProxyConnector, ProxyError, ProxyConnectionError, ProxyTimeoutError
+from config import (
+    PROXY_URLS, PROXY_ALLOW_DIRECT, PROXY_ROUTES, PROXY_PROBE_URL, PROXY_PROBE_INTERVAL,
+    PROXY_FAILURE_THRESHOLD, PROXY_COOLDOWN, HTTP_TIMEOUT
+)
+from deadline import remaining
+from overload import overload_controller
+
+DIRECT = 'direct'
+PROXY = 'proxy'
+ANY = 'any'
+
+# Errors that say nothing about the destination, only that this route didn't get there
+ROUTE_ERRORS = (aiohttp.ClientConnectionError, asyncio.TimeoutError, OSError, ProxyError, ProxyConnectionError, ProxyTimeoutError)
+# Errors raised before a request was sent, so it can safely be sent again over another route
+CONNECT_ERRORS = (aiohttp.ClientConnectorError, ProxyError, ProxyConnectionError, ProxyTimeoutError)
+
+
+class Route:
+    """One way out: an upstream proxy, or a direct connection when `url` is None"""
+
+    def __init__(self, url: str = None):
+        self.url = url
+        self.name = url or DIRECT
+        self.latency = None
+        self.failures = 0
+        self.open_until = 0
+        # Downloads report their results from executor threads
+        self._lock = threading.Lock()
+
+    @property
+    def is_direct(self) -> bool:
+        return self.url is None
+
+    @property
+    def available(self) -> bool:
+        return time.monotonic() >= self.open_until
+
+    def record_success(self, latency: float = None):
+        with self._lock:
+            if latency is not None:
+                self.latency = latency if self.latency is None else 0.7 * self.latency + 0.3 * latency
+            if self.failures >= PROXY_FAILURE_THRESHOLD:
+                logging.info(f"Route {self.name} recovered")
+            self.failures = 0
+            self.open_until = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= PROXY_FAILURE_THRESHOLD:
+                if self.available:
+                    logging.warning(f"Route {self.name} failed {self.failures} times, skipping it for {PROXY_COOLDOWN}s")
+                self.open_until = time.monotonic() + PROXY_COOLDOWN
+
+    def connector(self) -> aiohttp.BaseConnector:
+        if self.is_direct:
+            return aiohttp.TCPConnector()
+        return ProxyConnector.from_url(self.url)
+
+
+def parse_policies(spec: str) -> list:
+    policies = []
+    for item in spec.split(","):
+        if "=" in item:
+            destination, policy = item.split("=", 1)
+            policies.append((destination.strip().lower(), policy.strip().lower()))
+    return policies
+
+
+class ProxyPool:
+    """Health-checked set of routes with per-destination policies and failover"""
+
+    def __init__(self, proxy_urls: list, allow_direct: bool = False, policies: list = None):
+        self.routes = [Route(url) for url in proxy_urls]
+        if allow_direct or not self.routes:
+            self.routes.append(Route())
+        self.policies = policies or []
+
+    def policy_for(self, destination: str) -> str:
+        host = (urlparse(destination).hostname if "://" in destination else destination).lower()
+        for pattern, policy in self.policies:
+            if host == pattern or host.endswith(f".{pattern}"):
+                return policy
+        return ANY
+
+    def candidates(self, destination: str) -> list:
+        """Routes to try for a destination, best first"""
+        policy = self.policy_for(destination)
+        if policy == DIRECT:
+            preferred = [route for route in self.routes if route.is_direct]
+        elif policy == PROXY:
+            preferred = [route for route in self.routes if not route.is_direct]
+        else:
+            preferred = list(self.routes)
+        # A direct-only policy still falls back to proxies, but a proxy-only one never goes direct
+        fallback = [route for route in self.routes if route not in preferred and not (policy == PROXY and route.is_direct)]
+
+        def by_health(routes):
+            healthy = sorted(
+                (route for route in routes if route.available),
+                key=lambda route: route.latency if route.latency is not None else float('inf')
+            )
+            # Routes with an open circuit are a last resort, not excluded
+            return healthy + [route for route in routes if not route.available]
+
+        return by_health(preferred) + by_health(fallback) or list(self.routes)
+
+    def best(self, destination: str) -> Route:
+        return self.candidates(destination)[0]
+
+    @asynccontextmanager
+    async def request(self, method: str, url: str, **kwargs):
+        """Like `session.request`, retried over the next route when a route can't connect"""
+        last_error = None
+        for route in self.candidates(url):
+            # Leave a second of slack so the caller's deadline cancels the request before
+            # aiohttp times out, which would otherwise be blamed on the route
+            timeout = kwargs.get('timeout') or aiohttp.ClientTimeout(total=min(HTTP_TIMEOUT, remaining(HTTP_TIMEOUT) + 1))
+            session = aiohttp.ClientSession(connector=route.connector())
+            try:
+                try:
+                    response = await session.request(method, url, **{**kwargs, 'timeout': timeout})
+                except ROUTE_ERRORS as e:
+                    route.record_failure()
+                    overload_controller.record_upstream(False)
+                    last_error = e
+                    logging.info(f"Request to {urlparse(url).hostname} via {route.name} failed: {e!r}")
+                    continue
+                route.record_success()
+                overload_controller.record_upstream(response.status < 500)
+                async with response:
+                    yield response
+                return
+            finally:
+                await session.close()
+        raise last_error or aiohttp.ClientConnectionError(f"No route available to {urlparse(url).hostname}")
+
+    async def probe(self, route: Route) -> bool:
+        started = time.monotonic()
+        try:
+            async with aiohttp.ClientSession(connector=route.connector()) as session:
+                async with session.get(PROXY_PROBE_URL, timeout=aiohttp.ClientTimeout(total=10)) as response:
+                    await response.read()
+        except Exception as e:
+            route.record_failure()
+            logging.info(f"Health probe via {route.name} failed: {e!r}")
+            return False
+        route.record_success(time.monotonic() - started)
+        return True
+
+    async def probe_all(self):
+        await asyncio.gather(*(self.probe(route) for route in self.routes))
+
+    async def run_health_checks(self):
+        while True:
+            await self.probe_all()
+            await asyncio.sleep(PROXY_PROBE_INTERVAL)
+
+
+proxy_pool = ProxyPool(PROXY_URLS, PROXY_ALLOW_DIRECT, parse_policies(PROXY_ROUTES))
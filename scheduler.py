@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import time
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import (
+    EditMessageCaption, EditMessageMedia, EditMessageReplyMarkup, EditMessageText, SendChatAction, SendMediaGroup
+)
+from config import TELEGRAM_GLOBAL_RATE, TELEGRAM_PRIVATE_CHAT_RATE, TELEGRAM_GROUP_CHAT_RATE, TELEGRAM_MAX_RETRIES
+
+HIGH = 0
+LOW = 1
+
+# Methods that put something into a chat and count against Telegram's flood limits
+LIMITED_PREFIXES = ('Send', 'Edit', 'Copy', 'Forward', 'Delete')
+# Edits where only the latest state matters
+COALESCED_EDITS = (EditMessageReplyMarkup, EditMessageText, EditMessageCaption, EditMessageMedia)
+# Nobody waits on these; they give way to anything the user is waiting for
+COSMETIC = (EditMessageReplyMarkup, SendChatAction)
+
+# Cosmetic calls wait for high-priority traffic at most this long, so a steady
+# stream of sends can't hold them back forever (seconds)
+LOW_PRIORITY_MAX_WAIT = 5
+
+# Per-chat buckets that have been idle this long are dropped
+IDLE_BUCKET_SECONDS = 300
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        # asyncio.Lock wakes waiters in order, which keeps a chat's messages in order
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float = 1) -> float:
+        """Seconds until `amount` tokens are available"""
+        self._refill()
+        blocked = max(0, self.blocked_until - time.monotonic())
+        # A media group can exceed the burst size; let it through once the bucket is full
+        amount = min(amount, self.capacity)
+        return max(blocked, (amount - self.tokens) / self.rate)
+
+    def take(self, amount: float = 1):
+        self.tokens -= amount
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class PendingEdit:
+    def __init__(self, method):
+        self.method = method
+        self.future = asyncio.get_event_loop().create_future()
+        self.waiters = 0
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    """Paces every outgoing Bot API call through global and per-chat token buckets.
+
+    Calls the user is waiting for go before cosmetic ones, RetryAfter is
+    waited out and retried, and queued edits of the same message collapse
+    into the latest one.
+    """
+
+    def __init__(self):
+        self._global = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+        self._chats = {}
+        self._pending_edits = {}
+        self._high_waiting = 0
+        self._no_high_waiting = asyncio.Event()
+        self._no_high_waiting.set()
+
+    def _chat_bucket(self, chat_id):
+        if chat_id is None:
+            return None
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 1000:
+                self._drop_idle_buckets()
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = TokenBucket(TELEGRAM_GROUP_CHAT_RATE if is_group else TELEGRAM_PRIVATE_CHAT_RATE, 3)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    def _drop_idle_buckets(self):
+        now = time.monotonic()
+        for chat_id, bucket in list(self._chats.items()):
+            if now - bucket.updated > IDLE_BUCKET_SECONDS and not bucket.lock.locked():
+                del self._chats[chat_id]
+
+    async def _acquire(self, chat_id, priority: int, amount: int):
+        if priority == HIGH:
+            self._high_waiting += 1
+            self._no_high_waiting.clear()
+        try:
+            if priority != HIGH:
+                try:
+                    await asyncio.wait_for(self._no_high_waiting.wait(), LOW_PRIORITY_MAX_WAIT)
+                except asyncio.TimeoutError:
+                    pass
+            chat_bucket = self._chat_bucket(chat_id) or self._global
+            async with chat_bucket.lock:
+                while True:
+                    wait = max(self._global.wait_time(amount), chat_bucket.wait_time(amount))
+                    if wait <= 0:
+                        self._global.take(amount)
+                        if chat_bucket is not self._global:
+                            chat_bucket.take(amount)
+                        return
+                    await asyncio.sleep(wait)
+        finally:
+            if priority == HIGH:
+                self._high_waiting -= 1
+                if not self._high_waiting:
+                    self._no_high_waiting.set()
+
+    async def _send(self, make_request, bot, method):
+        chat_id = getattr(method, 'chat_id', None)
+        for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == TELEGRAM_MAX_RETRIES:
+                    raise
+                logging.warning(f"Flood control on {type(method).__name__}, retrying in {e.retry_after}s")
+                # Hold back everything else for that chat (or everything, if the limit isn't per chat)
+                bucket = self._chat_bucket(chat_id) or self._global
+                bucket.block(e.retry_after)
+                await asyncio.sleep(e.retry_after)
+
+    async def __call__(self, make_request, bot, method):
+        if not type(method).__name__.startswith(LIMITED_PREFIXES):
+            return await self._send(make_request, bot, method)
+
+        chat_id = getattr(method, 'chat_id', None)
+        priority = LOW if isinstance(method, COSMETIC) else HIGH
+        amount = len(method.media) if isinstance(method, SendMediaGroup) else 1
+
+        if not isinstance(method, COALESCED_EDITS):
+            await self._acquire(chat_id, priority, amount)
+            return await self._send(make_request, bot, method)
+
+        key = (type(method), chat_id, getattr(method, 'message_id', None), getattr(method, 'inline_message_id', None))
+        pending = self._pending_edits.get(key)
+        if pending is not None:
+            # An edit of this message is still queued: make it send our newer version instead
+            pending.method = method
+            pending.waiters += 1
+            return await asyncio.shield(pending.future)
+
+        pending = PendingEdit(method)
+        self._pending_edits[key] = pending
+        try:
+            await self._acquire(chat_id, priority, amount)
+        except BaseException:
+            pending.future.cancel()
+            raise
+        finally:
+            if self._pending_edits.get(key) is pending:
+                del self._pending_edits[key]
+
+        try:
+            result = await self._send(make_request, bot, pending.method)
+        except Exception as e:
+            if pending.waiters:
+                pending.future.set_exception(e)
+            raise
+        if pending.waiters:
+            pending.future.set_result(result)
+        return result
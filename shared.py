@@ -1,11 +1,154 @@
+import logging
 import os
-from aiogram import Bot
+import time
+from aiogram import Bot, types
 from aiogram.client.bot import DefaultBotProperties
 from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.base import BaseSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ParseMode
-from config import API_TOKEN
+from aiogram.exceptions import TelegramEntityTooLarge, TelegramNetworkError
+from config import API_TOKEN, TELEGRAM_API_URL, TELEGRAM_API_LOCAL, TELEGRAM_API_UPLOAD_TIMEOUT
+from proxy import proxy_pool, CONNECT_ERRORS
+from scheduler import OutboundScheduler
 
-PROXY_URL = os.environ.get("PROXY_URL", "socks5://shadowsocks:1080")
+# How long to stay on the public API after the local server failed (seconds)
+LOCAL_API_RETRY_AFTER = 30
+# Largest file the public Bot API accepts (bytes)
+PUBLIC_API_UPLOAD_LIMIT = 50 * 1024 * 1024
 
-session = AiohttpSession(proxy=PROXY_URL)
+
+class PooledSession(BaseSession):
+    """Telegram session that sends each request over the best healthy route of the proxy pool"""
+
+    def __init__(self, pool, **kwargs):
+        super().__init__(**kwargs)
+        self.pool = pool
+        self._sessions = {}
+
+    def _session(self, route) -> AiohttpSession:
+        session = self._sessions.get(route.name)
+        if session is None:
+            session = AiohttpSession(proxy=route.url, api=self.api, timeout=self.timeout)
+            self._sessions[route.name] = session
+        return session
+
+    async def make_request(self, bot, method, timeout=None):
+        # A request that timed out may still have reached Telegram; sending a message
+        # or upload again would duplicate it, so only reads fail over after that
+        read_only = type(method).__name__.startswith('Get')
+        last_error = None
+        for route in self.pool.candidates(self.api.base):
+            try:
+                result = await self._session(route).make_request(bot, method, timeout)
+            except TelegramNetworkError as e:
+                route.record_failure()
+                if not read_only and not isinstance(e.__context__, CONNECT_ERRORS):
+                    raise
+                last_error = e
+                logging.info(f"Telegram request {type(method).__name__} via {route.name} failed: {e}")
+                continue
+            except CONNECT_ERRORS as e:
+                # Proxy errors reach us unwrapped; the request never left, so any method can fail over
+                route.record_failure()
+                last_error = TelegramNetworkError(method, f"{type(e).__name__}: {e}")
+                last_error.__cause__ = e
+                logging.info(f"Telegram request {type(method).__name__} via {route.name} failed to connect: {e}")
+                continue
+            route.record_success()
+            return result
+        raise last_error or TelegramNetworkError(method, "No route available to the Telegram API")
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        route = self.pool.best(url)
+        async for chunk in self._session(route).stream_content(url, headers, timeout, chunk_size, raise_for_status):
+            yield chunk
+
+    async def close(self):
+        for session in self._sessions.values():
+            await session.close()
+
+
+def _as_upload(value):
+    """Turn a file:// path meant for the local server into a regular multipart upload"""
+    if isinstance(value, str) and value.startswith('file://'):
+        return types.FSInputFile(value[len('file://'):])
+    media = getattr(value, 'media', None)
+    if isinstance(media, str) and media.startswith('file://'):
+        return value.model_copy(update={'media': _as_upload(media)})
+    if isinstance(value, list):
+        return [_as_upload(item) for item in value]
+    return value
+
+
+def _local_paths(value) -> list:
+    """Paths of the file:// references in a request field"""
+    if isinstance(value, str) and value.startswith('file://'):
+        return [value[len('file://'):]]
+    media = getattr(value, 'media', None)
+    if isinstance(media, str):
+        return _local_paths(media)
+    if isinstance(value, list):
+        return [path for item in value for path in _local_paths(item)]
+    return []
+
+
+class FallbackSession(BaseSession):
+    """Sends through a self-hosted Bot API server, and through the public API while it is unreachable"""
+
+    def __init__(self, local: BaseSession, public: BaseSession, **kwargs):
+        super().__init__(api=local.api, **kwargs)
+        self.local = local
+        self.public = public
+        self._local_down_until = 0
+
+    async def make_request(self, bot, method, timeout=None):
+        paths = [path for _, value in method for path in _local_paths(value)]
+        if time.monotonic() >= self._local_down_until:
+            local_timeout = timeout
+            if paths:
+                local_timeout = max(timeout or self.local.timeout, TELEGRAM_API_UPLOAD_TIMEOUT)
+            try:
+                return await self.local.make_request(bot, method, local_timeout)
+            except TelegramNetworkError as e:
+                # Same rule as PooledSession: a request that may have arrived isn't sent again
+                read_only = type(method).__name__.startswith('Get')
+                if not read_only and not isinstance(e.__context__, CONNECT_ERRORS):
+                    raise
+                logging.warning(f"Local Bot API server unreachable, using the public API for {LOCAL_API_RETRY_AFTER}s: {e}")
+                self._local_down_until = time.monotonic() + LOCAL_API_RETRY_AFTER
+
+        for path in paths:
+            if os.path.getsize(path) > PUBLIC_API_UPLOAD_LIMIT:
+                raise TelegramEntityTooLarge(
+                    method,
+                    f"{os.path.basename(path)} is over the public Bot API's 50 MB limit "
+                    f"and the local Bot API server is unreachable"
+                )
+        # The public API can't read our disk, so local paths become uploads again
+        method = method.model_copy(update={name: _as_upload(value) for name, value in method})
+        return await self.public.make_request(bot, method, timeout)
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        async for chunk in self.local.stream_content(url, headers, timeout, chunk_size, raise_for_status):
+            yield chunk
+
+    async def close(self):
+        await self.local.close()
+        await self.public.close()
+
+
+def local_file(path) -> types.InputFile | str:
+    """Reference a file on disk for upload: by path on a local Bot API server, as bytes otherwise"""
+    if TELEGRAM_API_URL and TELEGRAM_API_LOCAL:
+        return f"file://{path}"
+    return types.FSInputFile(path)
+
+
+if TELEGRAM_API_URL:
+    local_api = TelegramAPIServer.from_base(TELEGRAM_API_URL, is_local=TELEGRAM_API_LOCAL)
+    session = FallbackSession(AiohttpSession(api=local_api), PooledSession(proxy_pool))
+else:
+    session = PooledSession(proxy_pool)
+session.middleware(OutboundScheduler())
 bot = Bot(token=API_TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
@@ -0,0 +1,52 @@
+import time
+from config import HEDGE_MIN_DELAY, HEDGE_MAX_DELAY
+from models import SongInfo
+
+# Weight of the newest observation in the moving averages
+SMOOTHING = 0.2
+# Assumed download time of a source we know nothing about yet (seconds)
+DEFAULT_LATENCY = 20.0
+
+
+class SourceStats:
+    def __init__(self):
+        self.success_rate = 1.0
+        self.latency = DEFAULT_LATENCY
+        self.updated = 0
+
+    def record(self, success: bool, latency: float = None):
+        self.success_rate = (1 - SMOOTHING) * self.success_rate + SMOOTHING * (1.0 if success else 0.0)
+        if success and latency is not None:
+            self.latency = (1 - SMOOTHING) * self.latency + SMOOTHING * latency
+        self.updated = time.monotonic()
+
+
+class SourceRanker:
+    """Tracks recent success rate and download time per source platform"""
+
+    def __init__(self):
+        self._stats = {}
+
+    def stats(self, source: str) -> SourceStats:
+        return self._stats.setdefault(source, SourceStats())
+
+    def record(self, source: str, success: bool, latency: float = None):
+        self.stats(source).record(success, latency)
+
+    def rank(self, sources: dict) -> list:
+        """(source, url) pairs, most reliable and fastest first; ties keep the given order"""
+        return sorted(
+            sources.items(),
+            key=lambda item: (-round(self.stats(item[0]).success_rate, 1), self.stats(item[0]).latency)
+        )
+
+    def hedge_delay(self, source: str) -> float:
+        """How long to give a source before starting a second attempt elsewhere"""
+        return min(HEDGE_MAX_DELAY, max(HEDGE_MIN_DELAY, self.stats(source).latency * 1.5))
+
+
+source_ranker = SourceRanker()
+
+def download_url(song_info: SongInfo):
+    """URL a track's audio is downloaded and cached under"""
+    return song_info.youtube_music_url or next(iter(song_info.source_urls.values()), None)
@@ -1,13 +1,15 @@
+import asyncio
 import logging
 import time
-import aiohttp
 from urllib.parse import quote_plus
-from aiohttp_socks import ProxyConnector
-from config import CLIENT_ID, CLIENT_SECRET
-import os
-
-# Proxy configuration (connects to shadowsocks container)
-PROXY_URL = os.environ.get("PROXY_URL", "socks5://shadowsocks:1080")
+from cache import TTLCache
+from config import (
+    CLIENT_ID, CLIENT_SECRET, SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL,
+    SONG_INFO_CACHE_SIZE, SONG_INFO_CACHE_TTL, SONG_INFO_DB_TTL
+)
+from database import get_song_info, save_song_info
+from models import SongInfo
+from proxy import proxy_pool
 
 class SpotifyTokenManager:
     def __init__(self, client_id: str, client_secret: str):
@@ -30,16 +32,84 @@ class SpotifyTokenManager:
         }
         headers = {"Content-Type": "application/x-www-form-urlencoded"}
         
-        connector = ProxyConnector.from_url(PROXY_URL)
-        async with aiohttp.ClientSession(connector=connector) as session:
-            async with session.post(url, data=data, headers=headers) as response:
-                response_data = await response.json()
-                self.token = response_data["access_token"]
-                self.token_expiry = time.time() + 3590  # 1 hour minus 10 seconds
+        async with proxy_pool.request('POST', url, data=data, headers=headers) as response:
+            response_data = await response.json()
+            self.token = response_data["access_token"]
+            self.token_expiry = time.time() + 3590  # 1 hour minus 10 seconds
 
 SPOTIFY_TOKEN_MANAGER = SpotifyTokenManager(CLIENT_ID, CLIENT_SECRET)
 
-async def search_spotify(query, types='track', market=None, limit=1, offset=0, include_external=None):
+SEARCH_CACHE = TTLCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+_searches_in_flight = {}
+
+def normalize_query(query: str) -> str:
+    """Fold case, punctuation and whitespace so equivalent queries share a cache key"""
+    text = "".join(c if c.isalnum() else " " for c in query.casefold())
+    return " ".join(text.split())
+
+def _matches_query(track: dict, words: list) -> bool:
+    track_words = normalize_query(f"{track['artist']} {track['title']}").split()
+    return all(any(w.startswith(word) for w in track_words) for word in words)
+
+def _results_from_cached_prefix(normalized: str, options: tuple):
+    """Filter the results of the longest cached shorter query down to ones matching this query"""
+    words = normalized.split()
+    for end in range(len(normalized) - 1, 0, -1):
+        cached = SEARCH_CACHE.get((normalized[:end], options))
+        if cached:
+            matching = [track for track in cached if _matches_query(track, words)]
+            return matching or None
+    return None
+
+class PartialResults(list):
+    """Results filtered from a shorter query's cache while the real search is still running"""
+
+
+def _consume_search_result(task: asyncio.Task):
+    # Searches may finish after every waiter has gone; don't leave errors unretrieved
+    if not task.cancelled() and task.exception():
+        logging.error(f"Spotify search failed: {task.exception()}")
+
+async def search_spotify(query, types='track', market=None, limit=1, offset=0, include_external=None, allow_prefix=False):
+    """Search Spotify, reusing cached results for equivalent queries.
+
+    With `allow_prefix`, results cached for a shorter version of the query are
+    filtered and returned right away as `PartialResults` while the real request
+    keeps running and fills the cache for the next keystroke.
+    """
+    normalized = normalize_query(query)
+    options = (types, market, limit, offset, include_external)
+    key = (normalized, options)
+
+    cached = SEARCH_CACHE.get(key)
+    if cached is not None:
+        return cached
+
+    request = _searches_in_flight.get(key)
+    if request is None:
+        request = asyncio.ensure_future(_request_search(query.strip(), key))
+        request.add_done_callback(_consume_search_result)
+        _searches_in_flight[key] = request
+
+    if allow_prefix:
+        prefix_results = _results_from_cached_prefix(normalized, options)
+        if prefix_results:
+            return PartialResults(prefix_results)
+
+    # Shielded so that a cancelled waiter doesn't abort a request others are waiting on
+    return await asyncio.shield(request)
+
+async def _request_search(query: str, key: tuple):
+    try:
+        results = await _fetch_search(query, *key[1])
+    finally:
+        _searches_in_flight.pop(key, None)
+    if results is None:
+        return []
+    SEARCH_CACHE.set(key, results)
+    return results
+
+async def _fetch_search(query, types, market, limit, offset, include_external):
     url = "https://api.spotify.com/v1/search?"
     
     params = {
@@ -57,63 +127,74 @@ async def search_spotify(query, types='track', market=None, limit=1, offset=0, i
     
     headers = {'Authorization': f'Bearer {SPOTIFY_TOKEN}'}
     
-    connector = ProxyConnector.from_url(PROXY_URL)
-    async with aiohttp.ClientSession(connector=connector) as session:
-        async with session.get(url, headers=headers) as response:
-            if response.status == 200:
-                json_response = await response.json()
-                return [
-                    {
-                        'artist': track['artists'][0]['name'],
-                        'title': track['name'],
-                        'url': track['external_urls']['spotify'],
-                        'id': track['id']
-                    }
-                    for track in json_response['tracks']['items']
-                ]
-            else:
-                logging.error(f"Failed to search Spotify: {response.status}")
-                logging.error(await response.text())
-                return []
+    async with proxy_pool.request('GET', url, headers=headers) as response:
+        if response.status == 200:
+            json_response = await response.json()
+            return [
+                {
+                    'artist': track['artists'][0]['name'],
+                    'title': track['name'],
+                    'url': track['external_urls']['spotify'],
+                    'id': track['id']
+                }
+                for track in json_response['tracks']['items']
+            ]
+        else:
+            logging.error(f"Failed to search Spotify: {response.status}")
+            logging.error(await response.text())
+            return None
 
 
-async def fetch_song_info(url: str):
-    api_url = f"https://api.song.link/v1-alpha.1/links?url={url}"
+async def fetch_album_tracks(album_url: str, limit: int = 50):
+    """Get the tracks of a Spotify album in album order"""
+    album_id = album_url.rstrip('/').split('/')[-1].split('?')[0]
+    url = f"https://api.spotify.com/v1/albums/{album_id}/tracks?limit={min(limit, 50)}"
 
-    connector = ProxyConnector.from_url(PROXY_URL)
-    async with aiohttp.ClientSession(connector=connector) as session:
-        async with session.get(api_url) as response:
-            if response.status == 200:
-                data = await response.json()
-                return process_song_info(data)
-            else:
-                error_text = await response.text()
-                raise RuntimeError(f"song.link API returned {response.status}: {error_text[:200]}")
+    SPOTIFY_TOKEN = await SPOTIFY_TOKEN_MANAGER.get_token()
+    headers = {'Authorization': f'Bearer {SPOTIFY_TOKEN}'}
 
-def process_song_info(data: dict):
-    song_data = data.get('entitiesByUniqueId', {})
-    result = {}
-    
-    for key, value in song_data.items():
-        if 'thumbnailUrl' in value and "ANGHAMI_SONG" not in key and "BOOMPLAY_SONG" not in key and "SOUNDCLOUD" not in key:
-            result = {
-                'platform_urls': {'All': data.get('pageUrl')},
-                'title': value.get('title'),
-                'artistName': value.get('artistName'),
-                'thumbnailUrl': value.get('thumbnailUrl'),
-                'type': value.get('type', 'song')  # Add type information
+    tracks = []
+    while url and len(tracks) < limit:
+        async with proxy_pool.request('GET', url, headers=headers) as response:
+            if response.status != 200:
+                error_text = await response.text()
+                raise RuntimeError(f"Spotify API returned {response.status}: {error_text[:200]}")
+            json_response = await response.json()
+        tracks.extend(
+            {
+                'artist': track['artists'][0]['name'],
+                'title': track['name'],
+                'url': track['external_urls']['spotify'],
+                'id': track['id']
             }
-            
-            if "YOUTUBE" in key:
-                # Trying to avoid using YouTube song's info
-                continue
-            break
-
-    if result and 'linksByPlatform' in data:
-        platforms = {'spotify': 'Spotify', 'yandex': 'Yandex', 'soundcloud':'SoundCloud', 'youtubeMusic': 'YTMusic'}
-        platforms_data = data['linksByPlatform']
-
-        for platform, platform_name in platforms.items():
-            if platform in platforms_data:
-                result['platform_urls'][platform_name] = platforms_data[platform]['url']
-    return result
+            for track in json_response['items']
+        )
+        url = json_response.get('next')
+    return tracks[:limit]
+
+SONG_INFO_CACHE = TTLCache(SONG_INFO_CACHE_SIZE, SONG_INFO_CACHE_TTL)
+
+async def fetch_song_info(url: str):
+    cached = SONG_INFO_CACHE.get(url)
+    if cached is not None:
+        return cached
+
+    stored = await get_song_info(url, SONG_INFO_DB_TTL)
+    song_info = stored and SongInfo.from_bytes(stored)
+    if song_info:
+        SONG_INFO_CACHE.set(url, song_info)
+        return song_info
+
+    api_url = f"https://api.song.link/v1-alpha.1/links?url={url}"
+
+    async with proxy_pool.request('GET', api_url) as response:
+        if response.status == 200:
+            data = await response.json()
+            song_info = SongInfo.from_songlink(data)
+            if song_info:
+                SONG_INFO_CACHE.set(url, song_info)
+                await save_song_info(url, song_info.to_bytes())
+            return song_info
+        else:
+            error_text = await response.text()
+            raise RuntimeError(f"song.link API returned {response.status}: {error_text[:200]}")
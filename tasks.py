@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from config import DOWNLOAD_WORKERS, DOWNLOAD_TASK_LIMIT, ALBUM_TASK_LIMIT
+
+DOWNLOADS = 'download'
+ALBUMS = 'album'
+PREFETCH = 'prefetch'
+# Loops that run for the bot's whole lifetime; cancelled rather than waited for on shutdown
+BACKGROUND = 'background'
+
+
+class TaskInfo:
+    def __init__(self, name: str, owner, category: str):
+        self.name = name
+        self.owner = owner
+        self.category = category
+        self.submitted = time.monotonic()
+        # None while waiting for a free slot in its category
+        self.started = None
+
+
+class TaskManager:
+    """Runs work outside the update handlers, so they can return right away.
+
+    Every task is referenced until it finishes, named and attributed to an
+    owner (usually a user ID), and limited by its category's concurrency cap.
+    Failures are logged and, when the submitter passes `on_error`, reported to
+    whoever is waiting on the result.
+    """
+
+    def __init__(self, limits: dict = None):
+        self.limits = limits or {}
+        self._semaphores = {}
+        self._tasks = {}
+        # Moving average of how long a task of each category runs, once started (seconds)
+        self.durations = {}
+        self.failed = 0
+
+    def _semaphore(self, category: str):
+        if category in self.limits and category not in self._semaphores:
+            self._semaphores[category] = asyncio.Semaphore(self.limits[category])
+        return self._semaphores.get(category)
+
+    def submit(self, coro, name: str, owner=None, category: str = None, on_error=None) -> asyncio.Task:
+        """Schedule `coro`; `on_error(exception)` returns a coroutine that reports a failure"""
+        info = TaskInfo(name, owner, category)
+        task = asyncio.create_task(self._run(coro, info), name=name)
+        self._tasks[task] = info
+        task.add_done_callback(lambda _: self._finished(task, on_error))
+        return task
+
+    async def _run(self, coro, info: TaskInfo):
+        semaphore = self._semaphore(info.category)
+        try:
+            if semaphore is None:
+                info.started = time.monotonic()
+                return await coro
+            async with semaphore:
+                info.started = time.monotonic()
+                return await coro
+        finally:
+            # Silences the "never awaited" warning when cancelled while still queued
+            coro.close()
+
+    def _finished(self, task: asyncio.Task, on_error):
+        info = self._tasks.pop(task)
+        if info.started is not None:
+            duration = time.monotonic() - info.started
+            average = self.durations.get(info.category, duration)
+            self.durations[info.category] = 0.8 * average + 0.2 * duration
+        if task.cancelled() or task.exception() is None:
+            return
+        error = task.exception()
+        self.failed += 1
+        logging.error(f"Task '{info.name}' ({info.category}, owner {info.owner}) failed: {error!r}", exc_info=error)
+        if on_error:
+            self.submit(on_error(error), f"{info.name}: error report", info.owner)
+
+    def tasks(self, category: str = None, owner=None) -> list:
+        return [
+            info for info in self._tasks.values()
+            if (category is None or info.category == category) and (owner is None or info.owner == owner)
+        ]
+
+    def queued(self, category: str = None) -> int:
+        return sum(1 for info in self.tasks(category) if info.started is None)
+
+    def running(self, category: str = None) -> int:
+        return sum(1 for info in self.tasks(category) if info.started is not None)
+
+    async def shutdown(self, grace: float):
+        """Cancel background loops, give the other tasks `grace` seconds to finish, then cancel them"""
+        for task, info in list(self._tasks.items()):
+            if info.category == BACKGROUND:
+                task.cancel()
+
+        pending = list(self._tasks)
+        if not pending:
+            return
+        logging.info(f"Waiting up to {grace:.0f}s for {len(pending)} tasks to finish")
+        _, pending = await asyncio.wait(pending, timeout=grace)
+        for task in pending:
+            logging.info(f"Cancelling unfinished task '{self._tasks[task].name}'")
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+class DownloadExecutor(ThreadPoolExecutor):
+    """Thread pool for yt-dlp that knows how much work is waiting for a thread"""
+
+    def __init__(self, max_workers: int):
+        super().__init__(max_workers=max_workers, thread_name_prefix='download')
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+
+    def submit(self, fn, /, *args, **kwargs):
+        with self._lock:
+            self._queued += 1
+        return super().submit(self._tracked, fn, *args, **kwargs)
+
+    def _tracked(self, fn, *args, **kwargs):
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._running -= 1
+
+    def queued(self) -> int:
+        return self._queued
+
+    def running(self) -> int:
+        return self._running
+
+
+task_manager = TaskManager({DOWNLOADS: DOWNLOAD_TASK_LIMIT, ALBUMS: ALBUM_TASK_LIMIT})
+download_executor = DownloadExecutor(DOWNLOAD_WORKERS)
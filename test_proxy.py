@@ -54,9 +54,9 @@ async def test_song_link_api():
         print(f"Testing with URL: {test_url}")
         
         result = await fetch_song_info(test_url)
-        if result and result.get('title'):
-            print(f"   ✓ Successfully fetched song info: {result['title']} by {result.get('artistName', 'Unknown')}")
-            print(f"   Available platforms: {list(result.get('platform_urls', {}).keys())}")
+        if result and result.title:
+            print(f"   ✓ Successfully fetched song info: {result.title} by {result.artist_name or 'Unknown'}")
+            print(f"   Available platforms: {list(result.platform_urls)}")
             return True
         else:
             print("   ✗ Failed to fetch song info")
@@ -102,6 +102,48 @@ async def test_ip_check():
         print(f"   ✗ IP check failed: {str(e)}")
         return False
 
+async def test_proxy_pool():
+    """Probe every route of the configured proxy pool"""
+    print("\nTesting configured proxy pool routes...")
+    
+    try:
+        from proxy import proxy_pool
+        
+        await proxy_pool.probe_all()
+        for route in proxy_pool.routes:
+            if route.latency is not None and route.failures == 0:
+                print(f"   ✓ {route.name}: {route.latency * 1000:.0f} ms")
+            else:
+                print(f"   ✗ {route.name}: unreachable")
+        return any(route.failures == 0 for route in proxy_pool.routes)
+        
+    except Exception as e:
+        print(f"   ✗ Proxy pool test failed: {str(e)}")
+        return False
+
+async def test_bot_api_server():
+    """Test the configured Bot API server (a local telegram-bot-api or any stand-in for it)"""
+    print("\nTesting Bot API server...")
+    
+    try:
+        from config import API_TOKEN, TELEGRAM_API_URL
+        if not TELEGRAM_API_URL:
+            print("   ⚠ TELEGRAM_API_URL not set, the public Bot API is used")
+            return "skipped"
+        if not API_TOKEN:
+            print("   ⚠ TELEGRAM_TOKEN not set in environment variables")
+            return "skipped"
+        
+        from shared import bot
+        print(f"Testing with server: {TELEGRAM_API_URL}")
+        me = await bot.get_me()
+        print(f"   ✓ Server answered getMe for @{me.username}")
+        return True
+        
+    except Exception as e:
+        print(f"   ✗ Bot API server test failed: {str(e)}")
+        return False
+
 def test_youtube_proxy():
     """Test YouTube-dl proxy configuration"""
     print("\nTesting YouTube-dl proxy configuration...")
@@ -163,6 +205,10 @@ async def main():
     ip_result = await test_ip_check()
     results.append(("IP Check", ip_result))
     
+    # Test proxy pool routes
+    pool_result = await test_proxy_pool()
+    results.append(("Proxy Pool", pool_result))
+    
     # Test Spotify
     spotify_result = await test_spotify_proxy()
     if spotify_result == "skipped":
@@ -174,6 +220,13 @@ async def main():
     songlink_result = await test_song_link_api()
     results.append(("Song.link API", songlink_result))
     
+    # Test Bot API server
+    bot_api_result = await test_bot_api_server()
+    if bot_api_result == "skipped":
+        results.append(("Bot API Server", "SKIPPED"))
+    else:
+        results.append(("Bot API Server", bot_api_result))
+    
     # Test YouTube
     youtube_result = test_youtube_proxy()
     results.append(("YouTube-dl", youtube_result))
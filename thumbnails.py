@@ -0,0 +1,101 @@
+import asyncio
+import hashlib
+import logging
+import os
+from io import BytesIO
+from aiogram import types
+from PIL import Image
+from config import THUMBNAIL_DIR, THUMBNAIL_CACHE_BYTES
+from proxy import proxy_pool
+
+# Telegram ignores audio thumbnails that aren't JPEGs of at most 320px and 200KB
+THUMBNAIL_SIZE = 320
+THUMBNAIL_MAX_BYTES = 200 * 1024
+
+
+def make_thumbnail(data: bytes) -> bytes:
+    """Resize and compress artwork to Telegram's thumbnail spec"""
+    image = Image.open(BytesIO(data))
+    image = image.convert('RGB')
+    image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+
+    for quality in (90, 80, 70, 60, 50, 40):
+        output = BytesIO()
+        image.save(output, format='JPEG', quality=quality, optimize=True)
+        if output.tell() <= THUMBNAIL_MAX_BYTES:
+            break
+    return output.getvalue()
+
+
+class ThumbnailCache:
+    """Size-bounded on-disk LRU cache of thumbnails, each artwork URL fetched once"""
+
+    def __init__(self, directory, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._size = None
+        self._in_flight = {}
+
+    def _path(self, url: str):
+        return self.directory / f"{hashlib.sha1(url.encode()).hexdigest()}.jpg"
+
+    async def get(self, url: str):
+        """Path of the thumbnail for an artwork URL, or None if it can't be made"""
+        if not url:
+            return None
+
+        path = self._path(url)
+        if path.exists():
+            # Modification time doubles as the LRU timestamp
+            os.utime(path)
+            return path
+
+        request = self._in_flight.get(url)
+        if request is None:
+            request = asyncio.ensure_future(self._create(url, path))
+            self._in_flight[url] = request
+            request.add_done_callback(lambda _: self._in_flight.pop(url, None))
+        try:
+            return await asyncio.shield(request)
+        except Exception as e:
+            logging.info(f"Couldn't prepare thumbnail {url}: {e}")
+            return None
+
+    async def _create(self, url: str, path):
+        async with proxy_pool.request('GET', url) as response:
+            response.raise_for_status()
+            data = await response.read()
+
+        thumbnail = await asyncio.get_event_loop().run_in_executor(None, make_thumbnail, data)
+
+        temp_path = path.with_suffix('.tmp')
+        with open(temp_path, 'wb') as f:
+            f.write(thumbnail)
+        os.replace(temp_path, path)
+
+        if self._size is None:
+            self._size = sum(entry.stat().st_size for entry in self.directory.glob('*.jpg'))
+        else:
+            self._size += len(thumbnail)
+        if self._size > self.max_bytes:
+            self._evict()
+        return path
+
+    def _evict(self):
+        entries = sorted(self.directory.glob('*.jpg'), key=lambda entry: entry.stat().st_mtime)
+        size = sum(entry.stat().st_size for entry in entries)
+        # Evict down to 90% so that every new thumbnail doesn't trigger another scan
+        for entry in entries:
+            if size <= self.max_bytes * 0.9:
+                break
+            size -= entry.stat().st_size
+            entry.unlink(missing_ok=True)
+        self._size = size
+
+
+thumbnail_cache = ThumbnailCache(THUMBNAIL_DIR, THUMBNAIL_CACHE_BYTES)
+
+async def get_thumbnail(url: str):
+    """Thumbnail input file for an upload, or None to send without one"""
+    path = await thumbnail_cache.get(url)
+    return types.FSInputFile(path) if path else None
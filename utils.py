@@ -1,46 +1,69 @@
+import hashlib
 import os
 from html import escape
 from aiogram import types
+from cache import TTLCache
+from config import SONG_INFO_CACHE_SIZE, SONG_INFO_CACHE_TTL
+from database import get_file_ids
+from models import SongInfo
 from shared import bot
 
-async def create_message_text(song_info: dict) -> str:
+# Rendered cards by SongInfo; cached infos are shown over and over
+CARD_CACHE = TTLCache(SONG_INFO_CACHE_SIZE, SONG_INFO_CACHE_TTL)
+
+async def create_message_text(song_info: SongInfo) -> str:
+    card = CARD_CACHE.get(song_info)
+    if card is not None:
+        return card
+
     bot_info = await bot.get_me()
-    song_urls = " | ".join([f"<a href='{escape(song_url)}'>{escape(song_name)}</a>" for song_name, song_url in song_info['platform_urls'].items()])
+    song_urls = " | ".join([f"<a href='{escape(song_url)}'>{escape(song_name)}</a>" for song_name, song_url in song_info.platform_urls.items()])
     
     # Check if it's an album
-    is_album = song_info.get('type') == 'album'
+    is_album = song_info.is_album
     emoji = "💿" if is_album else "🎸"
     content_type = "Album" if is_album else "Track"
     
-    msg_text = f"<code>{escape(song_info['artistName'])} - {escape(song_info['title'])}</code>\n\n{emoji} {content_type}: {song_urls} {emoji}\n\n@{bot_info.username}"
+    msg_text = f"<code>{escape(song_info.artist_name)} - {escape(song_info.title)}</code>\n\n{emoji} {content_type}: {song_urls} {emoji}\n\n@{bot_info.username}"
+    CARD_CACHE.set(song_info, msg_text)
     return msg_text
 
 
-async def generate_inline_query_results(song_info: dict, preview=False) -> list:
+async def generate_inline_query_results(song_info: SongInfo, preview=False, file_ids: dict = None) -> list:
+    """Build inline results for a song; `file_ids` maps already uploaded YTMusic URLs to their file IDs"""
     message_text = await create_message_text(song_info)
-    yt_url = song_info['platform_urls'].get('YTMusic')
-    is_album = song_info.get('type') == 'album'
+    yt_url = song_info.youtube_music_url
+    is_album = song_info.is_album
 
     result = []
     
     input_content = types.InputTextMessageContent(
         message_text=message_text,
-        link_preview_options=types.LinkPreviewOptions(url=song_info['thumbnailUrl'], prefer_large_media=True, show_above_text=True)
+        link_preview_options=types.LinkPreviewOptions(url=song_info.thumbnail_url, prefer_large_media=True, show_above_text=True)
     )
     result.append(types.InlineQueryResultArticle(
-        id=song_info['platform_urls'].get('All'),
-        title=song_info['title'],
-        description=f"by {song_info['artistName']}",
-        thumbnail_url=song_info['thumbnailUrl'],
+        id=song_info.page_url,
+        title=song_info.title,
+        description=f"by {song_info.artist_name}",
+        thumbnail_url=song_info.thumbnail_url,
         input_message_content=input_content
     ))
     
+    file_id = (file_ids or {}).get(yt_url)
+
     # Only add download option for songs, not albums
-    if yt_url and not preview and not is_album:
+    if yt_url and file_id and not is_album:
+        # Already uploaded: deliver the audio itself, no chosen result round trip needed
+        result.append(types.InlineQueryResultCachedAudio(
+            id=f"cached:{hashlib.md5(yt_url.encode()).hexdigest()}",
+            audio_file_id=file_id,
+            caption=message_text
+        ))
+    elif yt_url and not preview and not is_album:
         result.append(types.InlineQueryResultAudio(
             id=yt_url,
-            title=song_info['title'],
-            performer=song_info['artistName'],
+            title=song_info.title,
+            performer=song_info.artist_name,
             audio_url=os.environ.get('LOADING_AUDIO_ID'),
             caption=message_text,
             reply_markup=types.InlineKeyboardMarkup(inline_keyboard=[
@@ -49,3 +72,12 @@ async def generate_inline_query_results(song_info: dict, preview=False) -> list:
     ))
     
     return result
+
+
+async def generate_inline_query_results_batch(song_infos: list, preview=False) -> list:
+    """Build inline results for several songs, looking up cached audio for all of them at once"""
+    file_ids = await get_file_ids([song_info.youtube_music_url for song_info in song_infos])
+    results = []
+    for song_info in song_infos:
+        results.extend(await generate_inline_query_results(song_info, preview, file_ids))
+    return results
@@ -0,0 +1,86 @@
+import asyncio
+import logging
+from datetime import datetime, timezone
+from config import (
+    WARMUP_ENABLED, WARMUP_CHAT_ID, WARMUP_STARTUP_DELAY, WARMUP_INTERVAL, WARMUP_HOURS,
+    WARMUP_DAYS, WARMUP_MAX_METADATA, WARMUP_MAX_DOWNLOADS, DOWNLOAD_DEADLINE
+)
+from deadline import deadline
+from models import SongInfo
+from database import get_popular_urls, get_trending_urls, get_popular_queries, get_file_ids
+from spotify import search_spotify, fetch_song_info
+from youtube import AudioFile, fetch_audio, upload_audio
+
+
+def is_off_peak(now: datetime = None) -> bool:
+    start, end = (int(hour) for hour in WARMUP_HOURS.split("-"))
+    hour = (now or datetime.now(timezone.utc)).hour
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+
+class CacheWarmer:
+    """Pre-resolves metadata and pre-uploads audio for the most requested tracks"""
+
+    async def run(self):
+        if not WARMUP_ENABLED:
+            return
+        await asyncio.sleep(WARMUP_STARTUP_DELAY)
+        await self.warm_up()
+        while True:
+            await asyncio.sleep(WARMUP_INTERVAL)
+            if is_off_peak():
+                await self.warm_up()
+
+    async def warm_up(self):
+        # Trending first, so new viral tracks win over long-time favourites when the budget runs out
+        urls = await get_trending_urls(WARMUP_MAX_METADATA)
+        for url in await get_popular_urls(WARMUP_DAYS, WARMUP_MAX_METADATA):
+            if url not in urls:
+                urls.append(url)
+
+        for query in await get_popular_queries(WARMUP_DAYS, WARMUP_MAX_METADATA // 2):
+            try:
+                urls.extend(result['url'] for result in await search_spotify(query))
+            except Exception as e:
+                logging.info(f"Warm-up search for '{query}' failed: {e}")
+
+        song_infos = {}
+        for url in urls[:WARMUP_MAX_METADATA]:
+            try:
+                song_info = await fetch_song_info(url)
+            except Exception as e:
+                logging.info(f"Warm-up of {url} failed: {e}")
+                continue
+            yt_url = song_info and song_info.youtube_music_url
+            if yt_url and not song_info.is_album:
+                song_infos.setdefault(yt_url, song_info)
+
+        downloaded = 0
+        if WARMUP_CHAT_ID:
+            file_ids = await get_file_ids(list(song_infos))
+            for yt_url, song_info in song_infos.items():
+                if downloaded >= WARMUP_MAX_DOWNLOADS:
+                    break
+                if yt_url in file_ids:
+                    continue
+                if await self._warm_audio(yt_url, song_info):
+                    downloaded += 1
+
+        logging.info(f"Cache warm-up done: {len(song_infos)} tracks resolved, {downloaded} uploaded")
+
+    async def _warm_audio(self, url: str, song_info: SongInfo) -> bool:
+        try:
+            async with deadline(DOWNLOAD_DEADLINE):
+                audio_file = await fetch_audio(url, song_info)
+                if not isinstance(audio_file, AudioFile):
+                    return False
+                await upload_audio(WARMUP_CHAT_ID, url, audio_file, disable_notification=True)
+                return True
+        except Exception as e:
+            logging.info(f"Warm-up download of {url} failed: {e}")
+            return False
+
+
+cache_warmer = CacheWarmer()
@@ -1,26 +1,91 @@
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+import glob
+import logging
+import threading
+import time
+from typing import NamedTuple
 import os
 import aiofiles
-from spotify import fetch_song_info
+from spotify import fetch_song_info, fetch_album_tracks
 import yt_dlp as youtube_dl
-from config import COOKIE_FILE, CACHE_DIR
+from yt_dlp.networking.exceptions import TransportError
+from yt_dlp.postprocessor import FFmpegExtractAudioPP
+from config import (
+    CACHE_DIR, ALBUM_DOWNLOAD_CONCURRENCY, ALBUM_MAX_TRACKS,
+    MAX_TRACK_DURATION, TELEGRAM_UPLOAD_LIMIT, DOWNLOAD_DEADLINE
+)
 from aiogram import types
-from shared import bot
+from shared import bot, local_file
 from utils import create_message_text
-from database import get_file_id, save_file_id
+from database import get_file_id, save_file_id, save_download_plan
+from planner import DownloadPlan, DownloadRefusal, REFUSED, plan_download
+from thumbnails import get_thumbnail
+from proxy import proxy_pool
+from sources import source_ranker
+from models import SongInfo
+from deadline import deadline, expires_at
+from ytdl_pool import ytdl_pool
+from overload import overload_controller
+from tasks import download_executor
 
-executor = ThreadPoolExecutor(max_workers=4)
 
-# Proxy configuration for yt-dlp (connects to shadowsocks container)
-PROXY_URL = os.environ.get("PROXY_URL", "socks5://shadowsocks:1080")
+# Downloads that were started ahead of time (e.g. prefetched) and not yet claimed, by URL
+pending_downloads = {}
 
-def download_audio(url: str, song_info: dict = None):
+class DownloadControl:
+    """Lets the event loop throttle or cancel a download running in the executor"""
+    def __init__(self, ratelimit: int = None, deadline: float = None):
+        self.ratelimit = ratelimit
+        # time.monotonic() after which the download gives up on its own
+        self.deadline = deadline
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def should_stop(self) -> bool:
+        return self.cancelled.is_set() or (self.deadline is not None and time.monotonic() > self.deadline)
+
+class AudioFile(NamedTuple):
+    filename: str
+    duration: int
+    performer: str
+    title: str
+    thumbnail: str
+    plan: DownloadPlan = None
+
+class DownloadJob:
+    def __init__(self, task: asyncio.Task, control: DownloadControl, song_info: SongInfo = None):
+        self.task = task
+        self.control = control
+        self.song_info = song_info
+
+def is_route_error(error: youtube_dl.utils.DownloadError) -> bool:
+    """Whether a download failed because the connection failed, not because of the video"""
+    cause = error.exc_info[1] if error.exc_info else None
+    return isinstance(cause, (TransportError, OSError))
+
+def download_audio(url: str, song_info: SongInfo = None, control: DownloadControl = None, tag: str = None):
+    """Download audio over the best route for its site, retrying once over another route"""
+    routes = proxy_pool.candidates(url)
+    for attempt, route in enumerate(routes[:2]):
+        try:
+            result = _download_audio(url, song_info, control, route.url, tag)
+        except youtube_dl.utils.DownloadError as e:
+            if attempt or len(routes) == 1 or not is_route_error(e):
+                raise
+            route.record_failure()
+            logging.info(f"Download of {url} via {route.name} failed, retrying over {routes[1].name}: {e}")
+            continue
+        route.record_success()
+        return result
+
+def _download_audio(url: str, song_info: SongInfo, control: DownloadControl, proxy: str, tag: str = None):
     # Create a safe filename from song info if available
-    if song_info and song_info.get('title') and song_info.get('artistName'):
+    if song_info and song_info.title and song_info.artist_name:
         # Clean filename by removing invalid characters
-        title = "".join(c for c in song_info['title'] if c.isalnum() or c in (' ', '-', '_')).strip()
-        artist = "".join(c for c in song_info['artistName'] if c.isalnum() or c in (' ', '-', '_')).strip()
+        title = "".join(c for c in song_info.title if c.isalnum() or c in (' ', '-', '_')).strip()
+        artist = "".join(c for c in song_info.artist_name if c.isalnum() or c in (' ', '-', '_')).strip()
         safe_filename = f"{artist} - {title}"
         # Limit filename length to avoid filesystem issues
         if len(safe_filename) > 100:
@@ -28,74 +93,259 @@ def download_audio(url: str, song_info: dict = None):
         outtmpl = f'{CACHE_DIR}/{safe_filename}.%(ext)s'
     else:
         outtmpl = f'{CACHE_DIR}/%(id)s.%(ext)s'
+    if tag:
+        # Keeps parallel downloads of the same track from different sources apart
+        outtmpl = outtmpl.replace('.%(ext)s', f' [{tag}].%(ext)s')
     
-    ydl_opts = {
-        'cookiefile': COOKIE_FILE,
-        'proxy': PROXY_URL,
-        
-        # 'verbose': True,
-        'quiet': True,
-        
-        'outtmpl': outtmpl,
-        'format': 'bestaudio',
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'aac',
-        }],
-    }
-
-    with youtube_dl.YoutubeDL(ydl_opts) as ydl:
+    control = control or DownloadControl()
+
+    with ytdl_pool.acquire(proxy) as instance:
+        ydl = instance.ydl
+        ydl.params['outtmpl']['default'] = outtmpl
+
+        def progress_hook(progress):
+            if control.should_stop():
+                raise youtube_dl.utils.DownloadCancelled()
+            # The downloader reads the limit on every chunk, so this can change mid-download
+            ydl.params['ratelimit'] = control.ratelimit
+
+        instance.on_progress = progress_hook
+        ydl.params['ratelimit'] = control.ratelimit
+
+        started = time.monotonic()
         info_dict = ydl.extract_info(url, download=False)
+        ytdl_pool.record_extraction(time.monotonic() - started)
         track_duration = info_dict.get('duration', 0)
 
-        if track_duration > 10 * 60:
-            return 'Track is too long'
+        if track_duration > MAX_TRACK_DURATION:
+            return DownloadRefusal.from_plan(DownloadPlan(
+                REFUSED, duration=track_duration, reason=f'Track is too long (max {MAX_TRACK_DURATION // 60} minutes)'
+            ))
+
+        # Choose the format from what extract_info already returned, before spending any bandwidth
+        plan = plan_download(info_dict, TELEGRAM_UPLOAD_LIMIT)
+        if plan.decision == REFUSED:
+            return DownloadRefusal.from_plan(plan)
 
-        ydl.download([url])
+        ydl.format_selector = ydl.build_format_selector(plan.format_id)
+        ydl.add_post_processor(FFmpegExtractAudioPP(ydl, preferredcodec='aac', preferredquality=plan.bitrate))
+
+        if control.should_stop():
+            raise youtube_dl.utils.DownloadCancelled()
+        try:
+            # Reuses the extracted info instead of extracting the video again like ydl.download would
+            ydl.process_ie_result(info_dict, download=True)
+        except BaseException:
+            remove_partial_files(ydl.prepare_filename(info_dict))
+            raise
 
         temp_filename = ydl.prepare_filename(info_dict)
         # Use .m4a extension for aac codec
         filename = f"{os.path.splitext(temp_filename)[0]}.m4a"
 
-        return (
+        return AudioFile(
             filename,
             track_duration,
             info_dict.get('uploader', ''),
             info_dict.get('title', ''),
-            info_dict.get('thumbnail', '')
+            info_dict.get('thumbnail', ''),
+            plan
         )
 
-async def download_and_send_audio(res: types.ChosenInlineResult):
-    url = res.result_id
-    file_id = await get_file_id(url)
+def remove_partial_files(filename: str):
+    """Delete what an interrupted download left behind: .part files, unconverted audio"""
+    base = os.path.splitext(filename)[0]
+    for path in glob.glob(f"{glob.escape(base)}.*"):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
 
-    if not file_id:
-        # Fetch song info first to get proper naming
-        song_info = await fetch_song_info(url)
-        
+def _consume_download_result(task: asyncio.Task):
+    # Nobody may be waiting on a background download; don't leave errors unretrieved
+    if not task.cancelled() and task.exception():
+        logging.info(f"Background download failed: {task.exception()}")
+
+def start_download(url: str, song_info: SongInfo, control: DownloadControl = None) -> DownloadJob:
+    """Start downloading in the background, to be picked up later by fetch_audio"""
+    job = pending_downloads.get(url)
+    if job:
+        return job
+
+    control = control or DownloadControl()
+    task = asyncio.ensure_future(asyncio.get_event_loop().run_in_executor(download_executor, lambda: download_audio(url, song_info, control)))
+    task.add_done_callback(_consume_download_result)
+    job = DownloadJob(task, control, song_info)
+    pending_downloads[url] = job
+    return job
+
+async def fetch_audio(url: str, song_info: SongInfo):
+    """Download audio for url, taking over a background download of it if there is one"""
+    job = pending_downloads.pop(url, None)
+    if job and not job.control.cancelled.is_set():
+        # The user is waiting now, so drop any bandwidth limit the job was started with
+        # and let it run as long as the user's request may
+        job.control.ratelimit = None
+        job.control.deadline = expires_at()
         try:
-            audio_file = await asyncio.get_event_loop().run_in_executor(executor, lambda: download_audio(url, song_info))
+            # Shielded so that the thread's result isn't lost when the wait is cancelled
+            audio_file = await asyncio.shield(job.task)
+        except asyncio.CancelledError:
+            job.control.cancel()
+            job.task.add_done_callback(remove_downloaded_file)
+            raise
         except Exception as e:
-            await report_download_failure(res, str(e))
-            return
+            logging.info(f"Background download of {url} failed, downloading again: {e}")
+        else:
+            await record_download_plan(url, audio_file)
+            return audio_file
 
-        if not audio_file:
-            await report_download_failure(res)
-            return
-        elif audio_file == 'Track is too long':
-            await report_download_failure(res, 'Track is too long')
-            return
+    audio_file = await hedged_download(url, song_info)
+    await record_download_plan(url, audio_file)
+    return audio_file
+
+def remove_downloaded_file(task: asyncio.Future):
+    """Done callback that deletes the file of a download whose result nobody will use"""
+    if task.cancelled() or task.exception():
+        return
+    audio_file = task.result()
+    if isinstance(audio_file, AudioFile) and os.path.exists(audio_file.filename):
+        os.remove(audio_file.filename)
+
+async def hedged_download(url: str, song_info: SongInfo):
+    """Download from the best-ranked source, starting the next one too when it is slow or fails.
+
+    The first successful download wins and the others are cancelled. Failures and
+    refusals of one source don't end the race while another one is still running.
+    """
+    sources = song_info.source_urls if song_info else {}
+    if url not in sources.values():
+        sources = {'Requested': url, **sources}
+    remaining = source_ranker.rank(sources)
+    hedging = len(remaining) > 1
+    loop = asyncio.get_event_loop()
+    attempts = {}
+    last_failure = None
+    refusal = None
+
+    def launch():
+        source, source_url = remaining.pop(0)
+        control = DownloadControl(deadline=expires_at())
+        task = asyncio.ensure_future(loop.run_in_executor(
+            download_executor, lambda: download_audio(source_url, song_info, control, source if hedging else None)
+        ))
+        attempts[task] = (source, control, time.monotonic())
+        return source
+
+    latest = launch()
+    try:
+        while attempts:
+            timeout = source_ranker.hedge_delay(latest) if remaining else None
+            done, _ = await asyncio.wait(attempts, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                logging.info(f"Download from {latest} is slow, also trying {remaining[0][0]}")
+                latest = launch()
+                continue
+
+            winner = None
+            for task in done:
+                source, _, started = attempts.pop(task)
+                try:
+                    result = task.result()
+                except Exception as e:
+                    source_ranker.record(source, False)
+                    overload_controller.record_upstream(False)
+                    last_failure = e
+                    logging.info(f"Download from {source} failed: {e}")
+                    continue
+                if winner is not None:
+                    remove_downloaded_file(task)
+                elif isinstance(result, AudioFile):
+                    source_ranker.record(source, True, time.monotonic() - started)
+                    overload_controller.record_upstream(True)
+                    winner = result
+                elif refusal is None:
+                    # Refusals (too long, too big) apply to the track, not to the source,
+                    # but another source may still deliver a file that fits
+                    logging.info(f"Download from {source} refused: {result}")
+                    refusal = result
+            if winner is not None:
+                return winner
+
+            if not attempts:
+                # A refusal is final once nothing else is running; failures move on to the next source
+                if refusal is not None:
+                    return refusal
+                if remaining:
+                    latest = launch()
+    finally:
+        for task, (_, control, _) in attempts.items():
+            control.cancel()
+            task.add_done_callback(remove_downloaded_file)
+
+    raise last_failure
+
+async def record_download_plan(url: str, audio_file):
+    """Store what the planner decided and how big the file really got, for tuning the planner"""
+    plan = getattr(audio_file, 'plan', None)
+    if not plan:
+        return
+    actual_size = None
+    if isinstance(audio_file, AudioFile) and os.path.exists(audio_file.filename):
+        actual_size = os.path.getsize(audio_file.filename)
+    logging.info(f"Download plan for {url}: {plan.decision} {plan.format_id or ''} estimated {plan.estimated_size}, actual {actual_size}")
+    try:
+        await save_download_plan(url, plan, actual_size)
+    except Exception as e:
+        logging.error(f"Failed to record download plan: {e}")
 
-        filename, duration, performer, title, thumbnail = audio_file
+async def upload_audio(chat_id: int, url: str, audio_file: AudioFile, **kwargs) -> str:
+    """Upload a downloaded track, remember its file ID and remove the local file"""
+    filename, duration, performer, title, thumbnail, _ = audio_file
+    try:
         async with aiofiles.open(filename, 'rb') as f:
-            input_file = types.FSInputFile(f.name)
-            file_msg = await bot.send_audio(res.from_user.id, input_file, duration=duration, performer=performer, title=title, thumbnail=types.URLInputFile(thumbnail))
-        file_id = file_msg.audio.file_id
+            input_file = local_file(f.name)
+            file_msg = await bot.send_audio(
+                chat_id, 
+                input_file, 
+                duration=duration, 
+                performer=performer, 
+                title=title, 
+                thumbnail=await get_thumbnail(thumbnail),
+                **kwargs
+            )
+    finally:
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    file_id = file_msg.audio.file_id
+    await save_file_id(url, file_id)
+    return file_id
+
+async def download_and_send_audio(res: types.ChosenInlineResult):
+    url = res.result_id
+    file_id = await get_file_id(url)
+
+    try:
+        async with deadline(DOWNLOAD_DEADLINE):
+            # Fetch song info first to get proper naming
+            song_info = await fetch_song_info(url)
 
-        await save_file_id(url, file_id)
-        os.remove(filename)
+            if not file_id:
+                audio_file = await fetch_audio(url, song_info)
+
+                if not audio_file:
+                    await report_download_failure(res)
+                    return
+                elif isinstance(audio_file, str):
+                    await report_download_failure(res, audio_file)
+                    return
+
+                file_id = await upload_audio(res.from_user.id, url, audio_file)
+    except Exception as e:
+        await report_download_failure(res, str(e))
+        return
 
-    song_info = await fetch_song_info(url)
     caption = await create_message_text(song_info)
     await bot.edit_message_media(inline_message_id=res.inline_message_id, media=types.InputMediaAudio(media=file_id, caption=caption))
 
@@ -114,37 +364,21 @@ async def download_and_send_audio_direct(chat_id: int, message_id: int, url: str
     file_id = await get_file_id(url)
 
     if not file_id:
-        # Fetch song info first to get proper naming
-        song_info = await fetch_song_info(url)
-        
         try:
-            audio_file = await asyncio.get_event_loop().run_in_executor(executor, lambda: download_audio(url, song_info))
-        except Exception as e:
-            await report_download_failure_direct(chat_id, message_id, str(e))
-            return
+            # One budget for fetching, downloading and uploading
+            async with deadline(DOWNLOAD_DEADLINE):
+                # Fetch song info first to get proper naming
+                song_info = await fetch_song_info(url)
+                audio_file = await fetch_audio(url, song_info)
 
-        if not audio_file:
-            await report_download_failure_direct(chat_id, message_id)
-            return
-        elif audio_file == 'Track is too long':
-            await report_download_failure_direct(chat_id, message_id, 'Track is too long (max 10 minutes)')
-            return
+                if not audio_file:
+                    await report_download_failure_direct(chat_id, message_id)
+                    return
+                elif isinstance(audio_file, str):
+                    await report_download_failure_direct(chat_id, message_id, audio_file)
+                    return
 
-        filename, duration, performer, title, thumbnail = audio_file
-        try:
-            async with aiofiles.open(filename, 'rb') as f:
-                input_file = types.FSInputFile(f.name)
-                file_msg = await bot.send_audio(
-                    chat_id, 
-                    input_file, 
-                    duration=duration, 
-                    performer=performer, 
-                    title=title, 
-                    thumbnail=types.URLInputFile(thumbnail)
-                )
-            file_id = file_msg.audio.file_id
-            await save_file_id(url, file_id)
-            os.remove(filename)
+                await upload_audio(chat_id, url, audio_file)
             
             # Update the original message to show success
             await bot.edit_message_reply_markup(
@@ -156,8 +390,6 @@ async def download_and_send_audio_direct(chat_id: int, message_id: int, url: str
             )
         except Exception as e:
             await report_download_failure_direct(chat_id, message_id, str(e))
-            if os.path.exists(filename):
-                os.remove(filename)
             return
     else:
         # File already exists in cache, send it directly
@@ -190,3 +422,157 @@ async def report_download_failure_direct(chat_id: int, message_id: int, error_ms
         )
     except Exception as e:
         print(f"Error reporting download failure: {e}")
+
+class AlbumProgress:
+    """Shows album download progress on the button of a single message"""
+    def __init__(self, chat_id: int, message_id: int, total: int):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.total = total
+        self.done = 0
+        self._last_update = 0
+
+    async def update(self, force: bool = False):
+        now = time.monotonic()
+        # Editing on every track would run into Telegram's per-chat limits
+        if not force and now - self._last_update < 3:
+            return
+        self._last_update = now
+        try:
+            await bot.edit_message_reply_markup(
+                chat_id=self.chat_id,
+                message_id=self.message_id,
+                reply_markup=types.InlineKeyboardMarkup(inline_keyboard=[
+                    [types.InlineKeyboardButton(text=f"⏳ Downloading... {self.done}/{self.total}", callback_data="downloading")]
+                ])
+            )
+        except Exception as e:
+            logging.info(f"Couldn't update album progress: {e}")
+
+    async def track_done(self):
+        self.done += 1
+        await self.update()
+
+async def prepare_album_track(track: dict, semaphore: asyncio.Semaphore, progress: AlbumProgress):
+    """Get an album track ready for a media group, downloading it unless its file ID is known"""
+    async with semaphore:
+        try:
+            async with deadline(DOWNLOAD_DEADLINE):
+                return await _prepare_album_track(track)
+        except Exception as e:
+            logging.info(f"Album track {track['url']} failed: {e}")
+            return None
+        finally:
+            await progress.track_done()
+
+async def _prepare_album_track(track: dict):
+    """Resolve, and if needed download, one album track"""
+    track_info = await fetch_song_info(track['url'])
+    yt_url = track_info and track_info.youtube_music_url
+    if not yt_url:
+        return None
+
+    file_id = await get_file_id(yt_url)
+    if file_id:
+        return yt_url, types.InputMediaAudio(media=file_id), None
+
+    audio_file = await fetch_audio(yt_url, track_info)
+    if not isinstance(audio_file, AudioFile):
+        return None
+    filename, duration, performer, title, thumbnail, _ = audio_file
+    media = types.InputMediaAudio(
+        media=local_file(filename),
+        duration=duration,
+        performer=performer,
+        title=title,
+        thumbnail=await get_thumbnail(thumbnail)
+    )
+    return yt_url, media, filename
+
+async def download_and_send_album(chat_id: int, message_id: int, song_info: SongInfo):
+    """Download album tracks in parallel and send them as ordered media groups"""
+    spotify_url = song_info.spotify_url
+    if not spotify_url:
+        await report_download_failure_direct(chat_id, message_id, 'No track list available for this album')
+        return
+
+    try:
+        tracks = await fetch_album_tracks(spotify_url, ALBUM_MAX_TRACKS)
+    except Exception as e:
+        await report_download_failure_direct(chat_id, message_id, str(e))
+        return
+
+    progress = AlbumProgress(chat_id, message_id, len(tracks))
+    await progress.update(force=True)
+
+    semaphore = asyncio.Semaphore(ALBUM_DOWNLOAD_CONCURRENCY)
+    jobs = [asyncio.create_task(prepare_album_track(track, semaphore, progress)) for track in tracks]
+    sent = 0
+    try:
+        # Telegram media groups hold up to 10 items; send each as soon as it is complete, in order
+        for start in range(0, len(jobs), 10):
+            prepared = [item for item in await asyncio.gather(*jobs[start:start + 10]) if item]
+            if prepared:
+                sent += await send_album_group(chat_id, prepared)
+    finally:
+        for job in jobs:
+            job.cancel()
+        for job in jobs:
+            if job.done() and not job.cancelled() and job.result() and job.result()[2]:
+                filename = job.result()[2]
+                if os.path.exists(filename):
+                    os.remove(filename)
+
+    if sent:
+        text = f"✅ Downloaded {sent}/{len(tracks)} tracks"
+        callback_data = "download_success"
+    else:
+        text = "❌ Download failed"
+        callback_data = "download_error"
+    await bot.edit_message_reply_markup(
+        chat_id=chat_id,
+        message_id=message_id,
+        reply_markup=types.InlineKeyboardMarkup(inline_keyboard=[
+            [types.InlineKeyboardButton(text=text, callback_data=callback_data)]
+        ])
+    )
+
+async def send_album_group(chat_id: int, prepared: list) -> int:
+    """Send prepared album tracks as one media group and remember new file IDs.
+
+    Media groups need at least two items, so a lone track is sent as plain audio;
+    if the group is rejected, its tracks are retried one by one.
+    """
+    if len(prepared) > 1:
+        try:
+            messages = await bot.send_media_group(chat_id, [media for _, media, _ in prepared])
+        except Exception as e:
+            logging.error(f"Failed to send album media group, sending its tracks one by one: {e}")
+        else:
+            for (url, _, filename), message in zip(prepared, messages):
+                if filename and message.audio:
+                    await save_file_id(url, message.audio.file_id)
+            return len(messages)
+
+    sent = 0
+    for url, media, filename in prepared:
+        if await send_album_track(chat_id, url, media, filename):
+            sent += 1
+    return sent
+
+async def send_album_track(chat_id: int, url: str, media: types.InputMediaAudio, filename: str) -> bool:
+    try:
+        message = await bot.send_audio(
+            chat_id,
+            media.media,
+            duration=media.duration,
+            performer=media.performer,
+            title=media.title,
+            thumbnail=media.thumbnail
+        )
+    except Exception as e:
+        logging.error(f"Failed to send album track {url}: {e}")
+        return False
+    if filename and message.audio:
+        await save_file_id(url, message.audio.file_id)
+    return True
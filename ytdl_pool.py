@@ -0,0 +1,176 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+import yt_dlp as youtube_dl
+from yt_dlp.networking.exceptions import TransportError
+from config import (
+    COOKIE_FILE, HTTP_TIMEOUT, YTDL_POOL_ENABLED, YTDL_MAX_USES, YTDL_MAX_AGE, YTDL_COOKIE_SAVE_INTERVAL
+)
+
+# Instances of all threads write the same cookie file
+_cookie_lock = threading.Lock()
+
+
+class PooledYoutubeDL:
+    """A configured YoutubeDL whose setup is paid once, used by one executor thread at a time"""
+
+    def __init__(self, proxy: str):
+        started = time.monotonic()
+        self.ydl = youtube_dl.YoutubeDL({
+            'cookiefile': COOKIE_FILE,
+            # An empty proxy means a direct connection
+            'proxy': proxy or '',
+            # Stalled connections fail instead of holding an executor thread
+            'socket_timeout': HTTP_TIMEOUT,
+            'quiet': True,
+            'format': 'bestaudio',
+        })
+        # Load the cookie jar now rather than during the first download
+        self.ydl.cookiejar
+        self.on_progress = None
+        self.ydl.add_progress_hook(self._progress_hook)
+        self._default_pps = list(self.ydl._pps['post_process'])
+
+        self.created = time.monotonic()
+        self.setup_time = self.created - started
+        self.cookies_saved = self.created
+        self.uses = 0
+        self.healthy = True
+
+    def _progress_hook(self, progress):
+        if self.on_progress:
+            self.on_progress(progress)
+
+    def expired(self) -> bool:
+        return not self.healthy or self.uses >= YTDL_MAX_USES or time.monotonic() - self.created > YTDL_MAX_AGE
+
+    def reset(self):
+        """Undo what a download configured, so the next one starts from the defaults"""
+        self.on_progress = None
+        self.ydl.params['ratelimit'] = None
+        self.ydl.format_selector = self.ydl.build_format_selector(self.ydl.params['format'])
+        self.ydl._pps['post_process'][:] = self._default_pps
+
+    def save_cookies(self):
+        with _cookie_lock:
+            self.ydl.save_cookies()
+        self.cookies_saved = time.monotonic()
+
+    def close(self):
+        try:
+            self.save_cookies()
+        except Exception as e:
+            logging.info(f"Couldn't save YouTube cookies: {e}")
+        finally:
+            self.healthy = False
+            self.ydl.close()
+
+
+class YoutubeDLPool:
+    """Keeps one YoutubeDL per executor thread and proxy, so the cookie jar, extractors
+    and connections survive between downloads.
+
+    Instances are recycled after YTDL_MAX_USES downloads or YTDL_MAX_AGE seconds,
+    and dropped right away after a connection error or an unexpected exception.
+    With the pool disabled every download gets a fresh instance, as before, which
+    is how the setup and extraction times in `stats` can be compared.
+    """
+
+    def __init__(self, enabled: bool = YTDL_POOL_ENABLED):
+        self.enabled = enabled
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._instances = set()
+        self.created = 0
+        self.reused = 0
+        self.recycled = 0
+        self.setup_seconds = 0.0
+        self.downloads = 0
+        self.extract_seconds = 0.0
+
+    def _thread_instances(self) -> dict:
+        if not hasattr(self._local, 'instances'):
+            self._local.instances = {}
+        return self._local.instances
+
+    def _create(self, proxy: str) -> PooledYoutubeDL:
+        instance = PooledYoutubeDL(proxy)
+        with self._lock:
+            self.created += 1
+            self.setup_seconds += instance.setup_time
+            self._instances.add(instance)
+        return instance
+
+    def _retire(self, instance: PooledYoutubeDL):
+        with self._lock:
+            self._instances.discard(instance)
+        instance.close()
+
+    @contextmanager
+    def acquire(self, proxy: str):
+        """A YoutubeDL for this thread and proxy; per-download settings are reset on release"""
+        instances = self._thread_instances()
+        instance = instances.pop(proxy, None)
+        if instance is not None and instance.expired():
+            with self._lock:
+                self.recycled += 1
+            self._retire(instance)
+            instance = None
+
+        if instance is None:
+            instance = self._create(proxy)
+        else:
+            with self._lock:
+                self.reused += 1
+        instance.uses += 1
+
+        try:
+            yield instance
+        except youtube_dl.utils.DownloadCancelled:
+            raise
+        except youtube_dl.utils.DownloadError as e:
+            # Video errors leave the instance fine; connection errors may leave it stuck
+            cause = e.exc_info[1] if e.exc_info else None
+            if isinstance(cause, (TransportError, OSError)):
+                instance.healthy = False
+            raise
+        except BaseException:
+            instance.healthy = False
+            raise
+        finally:
+            instance.reset()
+            if not self.enabled or not instance.healthy:
+                self._retire(instance)
+            else:
+                if time.monotonic() - instance.cookies_saved > YTDL_COOKIE_SAVE_INTERVAL:
+                    instance.save_cookies()
+                instances[proxy] = instance
+
+    def record_extraction(self, seconds: float):
+        with self._lock:
+            self.downloads += 1
+            self.extract_seconds += seconds
+
+    def stats(self) -> dict:
+        with self._lock:
+            downloads = self.downloads or 1
+            return {
+                'enabled': self.enabled,
+                'live': len(self._instances),
+                'created': self.created,
+                'reused': self.reused,
+                'recycled': self.recycled,
+                'setup_ms_per_download': self.setup_seconds * 1000 / downloads,
+                'extract_seconds_per_download': self.extract_seconds / downloads,
+            }
+
+    def close_all(self):
+        """Save cookies and close every instance, on shutdown"""
+        with self._lock:
+            instances = list(self._instances)
+        for instance in instances:
+            self._retire(instance)
+
+
+ytdl_pool = YoutubeDLPool()